@@ -1,5 +1,23 @@
+import asyncio
+import bisect
+import hashlib
+import inspect
+import json
+import logging
+import threading
+import time
+import weakref
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 
+from redis.exceptions import NoScriptError, ResponseError, WatchError
+
+
+# every ReadCache, so that a Session can invalidate the keys it wrote
+_read_caches = weakref.WeakSet()
+
 
 # generic container used to denote zset
 class zset():
@@ -7,6 +25,480 @@ class zset():
         self.primitive = primitive
 
 
+def _is_hash_type(field_type):
+    """ True if field_type is stored as a field of the entity's hash """
+    return field_type in (str, int, bool, float) or (
+        isinstance(field_type, type) and issubclass(field_type, Entity))
+
+
+class _FieldSpec():
+    """ Everything the Entity methods need to know about one field: how it is
+        stored, how to decode it, its key suffix, and the relation or lookup
+        it maintains. Specs are compiled once per class by _compile_fields,
+        so the methods do a single dict lookup instead of inspecting types
+        and rebuilding keys on every call.
+
+    """
+    __slots__ = ('name', 'kind', 'member_type', 'convert', 'suffix',
+                 'target', 'related', 'related_field', 'related_suffix',
+                 'related_set', 'lookup', 'lookup_prefix', 'lookup_suffix',
+                 'range_key', 'script_spec')
+
+    def decode(self, value):
+        """ Convert a raw hash value or member read from redis """
+        if value and self.convert is not None:
+            return self.convert(value)
+        return value
+
+    def decode_members(self, members):
+        if self.convert is None:
+            return set(members)
+        return set(self.decode(member) for member in members)
+
+    def decode_list(self, values):
+        if self.convert is None:
+            return list(values)
+        return [self.decode(value) for value in values]
+
+    def decode_pairs(self, pairs):
+        """ Convert the (member, score) pairs of a sorted set read """
+        return [(self.decode(member), score) for member, score in pairs]
+
+
+def _compile_fields(entity):
+    """ (Re)build the field specs of entity, called whenever its fields,
+        relations or lookups change.
+
+    """
+    specs = {}
+    for name, field_type in entity.fields.items():
+        spec = _FieldSpec()
+        spec.name = name
+        spec.suffix = ':'+name
+        if type(field_type) is set:
+            spec.kind = 'set'
+            for primitive_type in field_type:
+                spec.member_type = primitive_type
+        elif type(field_type) is zset:
+            spec.kind = 'zset'
+            spec.member_type = field_type.primitive
+        elif type(field_type) is list:
+            if len(field_type) != 1 or not field_type[0] in (str, int, bool,
+                                                            float):
+                raise TypeError('list fields hold a single primitive type')
+            spec.kind = 'list'
+            spec.member_type = field_type[0]
+        elif _is_hash_type(field_type):
+            spec.kind = 'hash'
+            spec.member_type = field_type
+        else:
+            raise TypeError('Unknown field type')
+        if spec.member_type in (int, bool, float):
+            spec.convert = spec.member_type
+        else:
+            spec.convert = None
+        # the class the field refers to, also set for one way relations
+        if (isinstance(spec.member_type, type) and
+                issubclass(spec.member_type, Entity)):
+            spec.target = spec.member_type
+        else:
+            spec.target = None
+        spec.lookup = entity.lookups.get(name)
+        if spec.kind == 'list' and spec.lookup is not None:
+            raise TypeError('list fields cannot have lookups')
+        spec.range_key = entity.range_indexes.get(name)
+        spec.lookup_prefix = name+':'
+        spec.lookup_suffix = ':'+entity.prefix
+        if name in entity.relations:
+            if entity.buckets is not None and spec.kind == 'hash':
+                raise TypeError('bucketed entities cannot relate hash fields')
+            other_entity, other_field_name = entity.relations[name]
+            spec.related = other_entity
+            spec.related_field = other_field_name
+            spec.related_suffix = ':'+other_field_name
+            spec.related_set = type(other_entity.fields[other_field_name]) \
+                is set
+            spec.script_spec = ['relation', other_entity.prefix,
+                                other_field_name,
+                                'set' if spec.related_set else 'hash']
+        else:
+            spec.related = None
+            spec.related_field = None
+            spec.related_suffix = None
+            spec.related_set = False
+            if spec.lookup is not None:
+                spec.script_spec = ['lookup', '1' if spec.lookup else '0', '',
+                                    '']
+            else:
+                spec.script_spec = ['', '', '', '']
+        specs[name] = spec
+    # update in place, AsyncEntity wrappers share the dict
+    entity._specs.clear()
+    entity._specs.update(specs)
+    # whether the keys of entity and of every class related to it are laid
+    # out as prefix:id and prefix:id:field, as the Lua scripts assume
+    entity._default_layout = all(
+        other.buckets is None and not other.hash_tags
+        for other in [entity] + [spec.related for spec in specs.values()
+                                 if spec.related is not None])
+
+
+def _bucket(value, buckets):
+    """ The bucket of value, stable across processes """
+    return zlib.crc32(value.encode('utf-8')) % buckets
+
+
+def _invalid_field(field):
+    raise TypeError('invalid field: '+field)
+
+
+class _Script():
+    """ A server-side Lua script invoked with EVALSHA. The SHA is computed once
+        when the script is defined, and the script is loaded into a client's
+        script cache the first time that client reports NOSCRIPT.
+
+    """
+    def __init__(self, source):
+        self.source = _SCRIPT_PRELUDE + source
+        self.sha = hashlib.sha1(self.source.encode('utf-8')).hexdigest()
+
+    def __call__(self, db, keys, args):
+        try:
+            return self._evalsha(db, keys, args)
+        except NoScriptError:
+            db.script_load(self.source)
+            return self._evalsha(db, keys, args)
+
+    def _evalsha(self, db, keys, args):
+        try:
+            return db.evalsha(self.sha, len(keys), *(list(keys)+list(args)))
+        except NoScriptError:
+            raise
+        except ResponseError as e:
+            _raise_script_error(e)
+
+    async def acall(self, db, keys, args):
+        """ Same as calling the script, on a redis.asyncio client """
+        try:
+            return await self._aevalsha(db, keys, args)
+        except NoScriptError:
+            await db.script_load(self.source)
+            return await self._aevalsha(db, keys, args)
+
+    async def _aevalsha(self, db, keys, args):
+        try:
+            return await db.evalsha(self.sha, len(keys),
+                                    *(list(keys)+list(args)))
+        except NoScriptError:
+            raise
+        except ResponseError as e:
+            _raise_script_error(e)
+
+
+def _raise_script_error(e):
+    """ Convert errors raised deliberately by the scripts below to the
+        exceptions raised by the equivalent python code.
+
+    """
+    message = str(e)
+    for tag, error in (('apollo-missing:', KeyError),
+                       ('apollo:', ValueError)):
+        if tag in message:
+            raise error(message.split(tag, 1)[1].strip())
+    raise e
+
+
+# ARGV[1..7] describe the field being mutated: the entity prefix and id, the
+# field name, whether the field is a 'relation', a 'lookup' or neither (''),
+# and then either the related prefix, related field name and related field
+# kind ('set' or 'hash'), or '1'/'0' for an injective/non-injective lookup.
+# ARGV[8..] are the values. Keys of related entities and lookups depend on the
+# stored values and are therefore derived inside the scripts. KEYS[1] is the
+# key being mutated and, for a range indexed hash field, KEYS[2] is the index.
+_SCRIPT_PRELUDE = """
+local prefix, id, field, mode = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local key = prefix .. ':' .. id
+
+local function release_hash_field()
+    local current = redis.call('HGET', key, field)
+    if not current or current == '' then
+        return
+    end
+    if mode == 'relation' then
+        local other_key = ARGV[5] .. ':' .. current
+        if ARGV[7] == 'set' then
+            redis.call('SREM', other_key .. ':' .. ARGV[6], id)
+        else
+            redis.call('HDEL', other_key, ARGV[6])
+        end
+    elseif mode == 'lookup' then
+        if ARGV[5] == '1' then
+            redis.call('HDEL', field .. ':' .. current, prefix)
+        else
+            redis.call('SREM', field .. ':' .. current .. ':' .. prefix, id)
+        end
+    end
+end
+"""
+
+_HSET_SCRIPT = _Script("""
+release_hash_field()
+local value = ARGV[8]
+if mode == 'relation' then
+    local other_key = ARGV[5] .. ':' .. value
+    if ARGV[7] == 'set' then
+        redis.call('SADD', other_key .. ':' .. ARGV[6], id)
+    else
+        local partner = redis.call('HGET', other_key, ARGV[6])
+        if partner then
+            redis.call('HDEL', prefix .. ':' .. partner, field)
+        end
+        redis.call('HSET', other_key, ARGV[6], id)
+    end
+elseif mode == 'lookup' then
+    if ARGV[5] == '1' then
+        redis.call('HSET', field .. ':' .. value, prefix, id)
+    else
+        redis.call('SADD', field .. ':' .. value .. ':' .. prefix, id)
+    end
+end
+if KEYS[2] then
+    redis.call('ZADD', KEYS[2], value, id)
+end
+return redis.call('HSET', key, field, value)
+""")
+
+_HDEL_SCRIPT = _Script("""
+release_hash_field()
+if KEYS[2] then
+    redis.call('ZREM', KEYS[2], id)
+end
+return redis.call('HDEL', key, field)
+""")
+
+_SADD_SCRIPT = _Script("""
+local set_key = key .. ':' .. field
+if mode == 'relation' and ARGV[7] == 'hash' then
+    for i = 8, #ARGV do
+        if redis.call('SISMEMBER', ARGV[5] .. 's', ARGV[i]) == 0 then
+            return redis.error_reply('ERR apollo-missing: ' .. ARGV[i] ..
+                                     ' has not been created yet')
+        end
+    end
+end
+local added = 0
+for i = 8, #ARGV do
+    local value = ARGV[i]
+    if mode == 'relation' then
+        local other_key = ARGV[5] .. ':' .. value
+        if ARGV[7] == 'set' then
+            redis.call('SADD', other_key .. ':' .. ARGV[6], id)
+        else
+            local owner = redis.call('HGET', other_key, ARGV[6])
+            if owner then
+                redis.call('SREM', prefix .. ':' .. owner .. ':' .. field,
+                           value)
+            end
+            redis.call('HSET', other_key, ARGV[6], id)
+        end
+    elseif mode == 'lookup' then
+        if ARGV[5] == '1' then
+            local reference = redis.call('HGET', field .. ':' .. value, prefix)
+            if reference then
+                redis.call('SREM', prefix .. ':' .. reference .. ':' .. field,
+                           value)
+            end
+            redis.call('HSET', field .. ':' .. value, prefix, id)
+        else
+            redis.call('SADD', field .. ':' .. value .. ':' .. prefix, id)
+        end
+    end
+    added = added + redis.call('SADD', set_key, value)
+end
+return added
+""")
+
+_SREM_SCRIPT = _Script("""
+local set_key = key .. ':' .. field
+if mode ~= '' then
+    for i = 8, #ARGV do
+        if redis.call('SISMEMBER', set_key, ARGV[i]) == 0 then
+            return redis.error_reply('ERR apollo: ' .. ARGV[i] ..
+                                     ' is not in ' .. id .. "'s " .. field)
+        end
+    end
+end
+local removed = 0
+for i = 8, #ARGV do
+    local value = ARGV[i]
+    if mode == 'relation' then
+        local other_key = ARGV[5] .. ':' .. value
+        if ARGV[7] == 'set' then
+            redis.call('SREM', other_key .. ':' .. ARGV[6], id)
+        else
+            redis.call('HDEL', other_key, ARGV[6])
+        end
+    elseif mode == 'lookup' then
+        if ARGV[5] == '1' then
+            redis.call('HDEL', field .. ':' .. value, prefix)
+        else
+            redis.call('SREM', field .. ':' .. value .. ':' .. prefix, id)
+        end
+    end
+    removed = removed + redis.call('SREM', set_key, value)
+end
+return removed
+""")
+
+
+class ReadCache():
+    """ A size bounded LRU cache for Entity reads (hget, smembers, lookup and
+        exists). Enable it by assigning an instance to the cache attribute of
+        an Entity subclass; several classes may share one cache.
+
+        Entries are dropped whenever apollo itself writes to the underlying
+        fields, including the related fields and lookups that a write touches
+        implicitly. Writes made by other processes are only seen after
+        calling listen(), which subscribes to invalidation messages from the
+        server.
+
+        Hit, miss, eviction and invalidation counts are kept as attributes and
+        are also returned by stats().
+
+    """
+    def __init__(self, maxsize=10000):
+        if maxsize < 1:
+            raise ValueError('maxsize must be positive')
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # entry -> (value, tags), in least to most recently used order
+        self._entries = OrderedDict()
+        # tag -> set of entries. A tag is either a redis key or a tuple naming
+        # a whole family of entries, such as one field of every entity.
+        self._tagged = {}
+        # bumped by every invalidation, so that a value read from redis
+        # while an invalidation was in flight is not stored
+        self._epoch = 0
+        self._lock = threading.Lock()
+        self._listener = None
+        _read_caches.add(self)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations}
+
+    def fetch(self, entry, tags, load):
+        """ Return the cached value of entry, calling load() to compute and
+            store it on a miss.
+
+        """
+        with self._lock:
+            if entry in self._entries:
+                self._entries.move_to_end(entry)
+                self.hits += 1
+                return self._entries[entry][0]
+            self.misses += 1
+            epoch = self._epoch
+        value = load()
+        with self._lock:
+            if epoch == self._epoch and entry not in self._entries:
+                self._entries[entry] = (value, tags)
+                for tag in tags:
+                    self._tagged.setdefault(tag, set()).add(entry)
+                while len(self._entries) > self.maxsize:
+                    self._drop(next(iter(self._entries)))
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, *tags):
+        """ Drop every entry carrying any of tags """
+        with self._lock:
+            self._epoch += 1
+            for tag in tags:
+                for entry in list(self._tagged.get(tag, ())):
+                    self._drop(entry)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._tagged.clear()
+
+    def _drop(self, entry):
+        value, tags = self._entries.pop(entry)
+        for tag in tags:
+            entries = self._tagged[tag]
+            entries.discard(entry)
+            if not entries:
+                del self._tagged[tag]
+
+    def listen(self, db, mode='tracking', sleep_time=0.01):
+        """ Invalidate entries when any client modifies their keys, using a
+            background thread.
+
+            With mode='tracking' (redis 6+) a dedicated connection enables
+            CLIENT TRACKING in broadcast mode and redirects the invalidation
+            messages to a pubsub connection. With mode='keyspace' the cache
+            subscribes to keyspace notifications instead, which must already
+            be enabled on the server with notify-keyspace-events (e.g. 'KA').
+
+        """
+        if self._listener is not None:
+            raise RuntimeError('cache is already listening')
+        pubsub = db.pubsub(ignore_subscribe_messages=True)
+        tracker = None
+        if mode == 'tracking':
+            def _handler(message):
+                if message['data'] is None:
+                    # the server flushed the db or lost track of the keys
+                    self.clear()
+                else:
+                    self.invalidate(*message['data'])
+            # tracking lasts as long as the connection that enabled it, so
+            # hold a dedicated one open for the lifetime of the listener
+            tracker = db.pubsub()
+            try:
+                pubsub.execute_command('CLIENT', 'ID')
+                client_id = pubsub.parse_response()
+                pubsub.subscribe(**{'__redis__:invalidate': _handler})
+                tracker.execute_command('CLIENT', 'TRACKING', 'ON',
+                                        'REDIRECT', client_id, 'BCAST')
+                tracker.parse_response()
+            except Exception:
+                tracker.close()
+                pubsub.close()
+                raise
+        elif mode == 'keyspace':
+            def _handler(message):
+                self.invalidate(message['channel'].split(':', 1)[1])
+            pubsub.psubscribe(**{'__keyspace@*__:*': _handler})
+        else:
+            raise ValueError('unknown mode: '+mode)
+        thread = pubsub.run_in_thread(sleep_time=sleep_time, daemon=True)
+        self._listener = (thread, pubsub, tracker)
+
+    def stop_listening(self):
+        if self._listener is not None:
+            thread, pubsub, tracker = self._listener
+            thread.stop()
+            thread.join()
+            pubsub.close()
+            if tracker is not None:
+                tracker.close()
+            self._listener = None
+
+
 def check_field(func):
     @wraps(func)
     def _wrapper(self_cls, field, *args, **kwargs):
@@ -16,7 +508,570 @@ def check_field(func):
     return _wrapper
 
 
-def _set_relation(entity1, field1, entity2):
+def _sscan_batches(db, key, count):
+    """ Yield the members of the set at key in batches using SSCAN """
+    cursor = 0
+    while True:
+        cursor, members = db.sscan(key, cursor, count=count)
+        if members:
+            yield members
+        if int(cursor) == 0:
+            break
+
+
+class _ChunkedPipeline():
+    """ Wraps a redis client so that queued commands are sent in MULTI/EXEC
+        transactions of at most chunk_size commands each.
+
+    """
+    def __init__(self, db, chunk_size):
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be positive')
+        self._db = db
+        self._chunk_size = chunk_size
+        self._pipe = db.pipeline(transaction=True)
+        self._queued = 0
+        self._results = []
+
+    def __getattr__(self, name):
+        command = getattr(self._pipe, name)
+
+        @wraps(command)
+        def _queue(*args, **kwargs):
+            command(*args, **kwargs)
+            self._queued += 1
+            if self._queued >= self._chunk_size:
+                self._flush()
+        return _queue
+
+    def _flush(self):
+        if self._queued:
+            self._results.extend(self._pipe.execute())
+            self._pipe = self._db.pipeline(transaction=True)
+            self._queued = 0
+
+    def execute(self):
+        self._flush()
+        results, self._results = self._results, []
+        return results
+
+
+def _ring_hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+# commands of optimistic transactions, which cannot span several nodes
+_TRANSACTION_COMMANDS = ('watch', 'unwatch', 'multi', 'transaction')
+
+# commands that do not name a key, and so cannot be routed to one node
+_KEYLESS_COMMANDS = ('scan', 'keys', 'dbsize', 'randomkey', 'flushdb',
+                     'flushall', 'ping', 'info', 'time')
+
+
+def _command_keys(name, args):
+    """ The keys a command operates on, given its positional arguments """
+    if name in _TRANSACTION_COMMANDS:
+        raise ValueError(name+' is not supported by ShardedRedis, as the '
+                         'watched keys may live on several nodes')
+    if name in _KEYLESS_COMMANDS or not args:
+        raise ValueError(name+' does not name a key, send it to each of '
+                         'the nodes instead')
+    if name in ('sinterstore', 'sunionstore', 'sdiffstore'):
+        return [args[0]] + list(args[1])
+    if name == 'sintercard':
+        return list(args[1])
+    if name in ('delete', 'exists', 'unlink'):
+        return list(args)
+    if isinstance(args[0], (list, tuple)):
+        return list(args[0])
+    return [args[0]]
+
+
+class ShardedRedis():
+    """ A client that spreads keys over several redis servers by consistent
+        hashing, and can be passed as the db of any Entity method:
+
+    db = apollo.ShardedRedis({'a': redis.Redis(port=6379),
+                              'b': redis.Redis(port=6380)})
+    joe = Person.create('joe', db)
+
+        Each command is sent to the node owning its key. As in redis cluster,
+        only the part of a key between the first { and the following } is
+        hashed when present, so an Entity declaring hash_tags = True keeps
+        all of its keys on one node. Commands on several keys need all of
+        them on one node. Pipelines are split per node and executed node by
+        node, so a transaction is atomic on each node but not across nodes.
+        WATCH and explicit MULTI are not supported and raise ValueError:
+        create_many then skips its WATCH, and a Session with watch=True
+        cannot be used. Lua scripts are not routed, and scripted entities
+        fall back to the client-side path.
+
+        nodes maps names to clients, and a key's node depends only on the
+        names, so adding a node only moves the keys it takes over, see
+        reshard.
+
+    """
+    def __init__(self, nodes, replicas=64):
+        self.nodes = dict(nodes)
+        self._ring = sorted((_ring_hash(name+'#'+str(i)), name)
+                            for name in self.nodes for i in range(replicas))
+        self._points = [point for point, _ in self._ring]
+
+    def node_name(self, key):
+        """ Name of the node owning key """
+        start = key.find('{')
+        if start != -1:
+            end = key.find('}', start+1)
+            if end > start+1:
+                key = key[start+1:end]
+        index = bisect.bisect(self._points, _ring_hash(key))
+        return self._ring[index % len(self._ring)][1]
+
+    def _route(self, name, args):
+        """ Name of the node to send command name with args to """
+        nodes = set(self.node_name(key) for key in _command_keys(name, args))
+        if len(nodes) != 1:
+            raise ValueError(name+' keys span several nodes')
+        return nodes.pop()
+
+    def pipeline(self, transaction=True):
+        return _ShardedPipeline(self, transaction)
+
+    def scan_iter(self, match=None, count=None, _type=None):
+        """ Iterate over the keys of every node with SCAN, one node after
+            another.
+
+        """
+        for node in self.nodes.values():
+            for key in node.scan_iter(match=match, count=count, _type=_type):
+                yield key
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def _command(*args, **kwargs):
+            node = self.nodes[self._route(name, args)]
+            return getattr(node, name)(*args, **kwargs)
+        return _command
+
+
+class _ShardedPipeline():
+    """ Pipeline of a ShardedRedis, queueing each command on a pipeline of its
+        node and returning the results in the order the commands were queued.
+
+    """
+    def __init__(self, db, transaction):
+        self._db = db
+        self._transaction = transaction
+        self._pipes = {}
+        self._order = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def _queue(*args, **kwargs):
+            node = self._db._route(name, args)
+            if not node in self._pipes:
+                self._pipes[node] = self._db.nodes[node].pipeline(
+                    transaction=self._transaction)
+            getattr(self._pipes[node], name)(*args, **kwargs)
+            self._order.append(node)
+            return self
+        return _queue
+
+    def execute(self):
+        pipes, order = self._pipes, self._order
+        self._pipes, self._order = {}, []
+        results = dict((node, iter(pipe.execute()))
+                       for node, pipe in pipes.items())
+        return [next(results[node]) for node in order]
+
+
+def reshard(source, target, batch_size=1000):
+    """ Move the keys of every node of the ShardedRedis source that the
+        ShardedRedis target places on another node, such as after adding a
+        node to target. Nodes are matched by name. Each node is walked with
+        SCAN, and every batch of at most batch_size keys is copied with DUMP
+        and RESTORE, keeping TTLs, using one pipeline per node involved. The
+        batch is WATCHed on its old node from before the DUMP until it is
+        deleted there, and copied again if any of it was written in between,
+        so no write to the old node is lost. Keys gone before their DUMP are
+        skipped. Hash tagged entities move with all of their keys. Clients
+        should write through target once resharding starts, as writes
+        through source recreate moved keys on their old node. Returns the
+        number of keys moved.
+
+    """
+    moved = 0
+    for name, node in source.nodes.items():
+        batch = []
+        for key in node.scan_iter(count=batch_size):
+            if target.node_name(key) != name:
+                batch.append(key)
+            if len(batch) == batch_size:
+                moved += _move_keys(node, batch, target)
+                batch = []
+        if batch:
+            moved += _move_keys(node, batch, target)
+    return moved
+
+
+def _move_keys(node, keys, target):
+    """ Copy keys from node to their nodes in target and delete them from
+        node, returning the number moved. See reshard.
+
+    """
+    while True:
+        watched = node.pipeline(transaction=True)
+        try:
+            watched.watch(*keys)
+            pipe = node.pipeline(transaction=False)
+            for key in keys:
+                pipe.dump(key)
+                pipe.pttl(key)
+            results = pipe.execute()
+            restored = []
+            pipes = {}
+            for key, dumped, ttl in zip(keys, results[::2], results[1::2]):
+                if dumped is None:
+                    continue
+                name = target.node_name(key)
+                if not name in pipes:
+                    pipes[name] = target.nodes[name].pipeline(
+                        transaction=False)
+                pipes[name].restore(key, max(ttl, 0), dumped, replace=True)
+                restored.append(key)
+            for pipe in pipes.values():
+                pipe.execute()
+            if not restored:
+                return 0
+            watched.multi()
+            watched.delete(*restored)
+            watched.execute()
+            return len(restored)
+        except WatchError:
+            # written since the DUMP, copy the batch again
+            continue
+        finally:
+            watched.reset()
+
+
+class _SessionKey():
+    """ What a Session knows about one key: values maps hash fields to their
+        value (None if deleted), or set members to whether they are members.
+        If complete, anything not in values is known to be absent.
+
+    """
+    __slots__ = ('values', 'complete')
+
+    def __init__(self):
+        self.values = {}
+        self.complete = False
+
+
+class Session():
+    """ A unit of work. Entities bound to a session, by passing the session
+        as their db, buffer their mutations, including the relation and
+        lookup writes those imply, and flush them all in one MULTI/EXEC:
+
+    with apollo.Session(db) as session:
+        joe = session.get(Person, 'joe')
+        joe.hset('ssn', '123-45-6789')
+        joe.hincrby('age')
+        joe.sadd('friends', session.get(Person, 'bob'))
+    # flushed here in one round trip, or discarded if an exception was raised
+
+        The session keeps an identity map of entities, and of every hash
+        field and set member it has read or written, so repeated reads are
+        answered from memory and reads see the session's own buffered writes.
+        Reads queued in a pipeline are fetched in one round trip. With watch,
+        every key read from the server is WATCHed, and flush raises
+        redis.exceptions.WatchError if any of them changed in the meantime.
+
+        Only hash and set reads go through the identity map. Other reads,
+        such as sorted set and list ranges and queries, see the committed
+        state, and pushes onto lists return None. The
+        read caches of entities are bypassed while bound to a session, and
+        the keys written are invalidated in every ReadCache on flush. Lua
+        scripts are not used by bound entities.
+
+    """
+    # commands that write hashes and sets, which update the identity map
+    _WRITES = ('hset', 'hdel', 'hincrby', 'sadd', 'srem', 'delete')
+    # other writes, which are only buffered
+    _DEFERRED = ('zadd', 'zrem', 'zincrby', 'zremrangebyrank', 'rpush',
+                 'lpush', 'ltrim')
+    _READS = ('hget', 'hmget', 'hgetall', 'hexists', 'smembers', 'scard',
+              'sismember', 'smismember')
+
+    def __init__(self, db, watch=False):
+        if watch and isinstance(db, ShardedRedis):
+            raise ValueError('a Session on a ShardedRedis cannot watch')
+        self.db = db
+        self.watch = watch
+        self._keys = {}
+        self._entities = {}
+        self._writes = []
+        self._watched = set()
+        self._pipe = db.pipeline(transaction=True) if watch else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+
+    def get(self, entity, id, verify=True):
+        """ The instance of entity for id bound to this session, the same
+            object for every call with the same entity and id.
+
+        """
+        if not (entity, id) in self._entities:
+            self._entities[(entity, id)] = entity(id, self, verify=verify)
+        return self._entities[(entity, id)]
+
+    def flush(self):
+        """ Send every buffered write in a single MULTI/EXEC and start over """
+        writes = self._writes
+        keys = set()
+        for name, args, kwargs in writes:
+            keys.update(args if name == 'delete' else args[:1])
+        try:
+            if self._pipe is not None:
+                pipe = self._pipe
+                pipe.multi()
+            else:
+                pipe = self.db.pipeline(transaction=True)
+            for name, args, kwargs in writes:
+                getattr(pipe, name)(*args, **kwargs)
+            if writes:
+                pipe.execute()
+        finally:
+            self.discard()
+            for cache in list(_read_caches):
+                cache.invalidate(*keys)
+
+    def discard(self):
+        """ Drop the buffered writes and everything read so far """
+        self._keys = {}
+        self._entities = {}
+        self._writes = []
+        self._watched = set()
+        if self._pipe is not None:
+            self._pipe.reset()
+
+    def pipeline(self, transaction=True):
+        return _SessionPipeline(self)
+
+    def _state(self, key):
+        if not key in self._keys:
+            self._keys[key] = _SessionKey()
+        return self._keys[key]
+
+    def _needs(self, name, args):
+        """ The server reads, as (command, key, items), needed to answer
+            command name from the identity map.
+
+        """
+        key = args[0]
+        state = self._keys.get(key)
+        if state is not None and state.complete:
+            return []
+        known = state.values if state is not None else {}
+        if name in ('hgetall', 'smembers', 'scard'):
+            return [('hgetall' if name == 'hgetall' else 'smembers', key,
+                     None)]
+        if name in ('hget', 'hexists', 'hincrby'):
+            items = [args[1]]
+            command = 'hmget'
+        elif name == 'hmget':
+            items = list(args[1])
+            command = 'hmget'
+        elif name == 'sismember':
+            items = [args[1]]
+            command = 'smismember'
+        else:
+            items = list(args[1])
+            command = 'smismember'
+        items = [item for item in items if not item in known]
+        return [(command, key, items)] if items else []
+
+    def _load(self, needs):
+        """ Fetch needs from the server in one round trip """
+        if not needs:
+            return
+        keys = set(key for _, key, _ in needs) - self._watched
+        if self._pipe is not None and keys:
+            self._pipe.watch(*keys)
+            self._watched.update(keys)
+        pipe = self.db.pipeline(transaction=False)
+        for command, key, items in needs:
+            if items is None:
+                getattr(pipe, command)(key)
+            else:
+                getattr(pipe, command)(key, items)
+        for (command, key, items), result in zip(needs, pipe.execute()):
+            state = self._state(key)
+            if command == 'hgetall':
+                for field, value in result.items():
+                    state.values.setdefault(field, value)
+                state.complete = True
+            elif command == 'smembers':
+                for member in result:
+                    state.values.setdefault(member, True)
+                state.complete = True
+            elif command == 'hmget':
+                for field, value in zip(items, result):
+                    state.values.setdefault(field, value)
+            else:
+                for member, found in zip(items, result):
+                    state.values.setdefault(member, bool(found))
+
+    def _lookup(self, key, item):
+        state = self._keys[key]
+        return state.values.get(item, False if state.complete else None)
+
+    def _read(self, name, args):
+        """ Answer a read from the identity map, once loaded """
+        key = args[0]
+        state = self._keys[key]
+        if name == 'hget':
+            return state.values.get(args[1])
+        elif name == 'hexists':
+            return state.values.get(args[1]) is not None
+        elif name == 'hmget':
+            return [state.values.get(field) for field in args[1]]
+        elif name == 'hgetall':
+            return dict((field, value) for field, value in
+                        state.values.items() if value is not None)
+        elif name == 'smembers':
+            return set(member for member, found in state.values.items()
+                       if found)
+        elif name == 'scard':
+            return len([found for found in state.values.values() if found])
+        elif name == 'sismember':
+            return bool(state.values.get(args[1]))
+        else:
+            return [bool(state.values.get(member)) for member in args[1]]
+
+    def _write(self, name, args, kwargs):
+        """ Buffer a write and apply it to the identity map """
+        if name == 'hincrby':
+            key, field = args[0], args[1]
+            amount = args[2] if len(args) > 2 else kwargs.get('amount', 1)
+            state = self._keys[key]
+            value = int(state.values.get(field) or 0) + amount
+            state.values[field] = str(value)
+            self._writes.append((name, args, kwargs))
+            return value
+        self._writes.append((name, args, kwargs))
+        if name in self._DEFERRED:
+            return None
+        if name == 'delete':
+            for key in args:
+                state = self._state(key)
+                state.values = {}
+                state.complete = True
+            return len(args)
+        state = self._state(args[0])
+        if name == 'hset':
+            mapping = dict(kwargs.get('mapping') or {})
+            field = args[1] if len(args) > 1 else kwargs.get('key')
+            if field is not None:
+                mapping[field] = args[2] if len(args) > 2 else kwargs['value']
+            for field, value in mapping.items():
+                state.values[field] = str(value)
+            return len(mapping)
+        elif name == 'hdel':
+            for field in args[1:]:
+                state.values[field] = None
+            return len(args) - 1
+        else:
+            for member in args[1:]:
+                state.values[member] = name == 'sadd'
+            return len(args) - 1
+
+    def _execute(self, commands):
+        """ Run commands in order, loading every read they need first """
+        needs = []
+        for name, args, kwargs in commands:
+            if name in self._READS or name == 'hincrby':
+                needs.extend(self._needs(name, args))
+        self._load(needs)
+        results = []
+        for name, args, kwargs in commands:
+            if name in self._READS:
+                self._load(self._needs(name, args))
+                results.append(self._read(name, args))
+            elif name in self._WRITES or name in self._DEFERRED:
+                if name == 'hincrby':
+                    self._load(self._needs(name, args))
+                results.append(self._write(name, args, kwargs))
+            else:
+                results.append(getattr(self.db, name)(*args, **kwargs))
+        return results
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def _command(*args, **kwargs):
+            return self._execute([(name, args, kwargs)])[0]
+        return _command
+
+
+class _SessionPipeline():
+    """ Pipeline of a Session, whose reads are loaded in one round trip when
+        executed and whose writes are buffered in the session.
+
+    """
+    def __init__(self, session):
+        self._session = session
+        self._commands = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def _queue(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+        return _queue
+
+    def execute(self):
+        commands, self._commands = self._commands, []
+        return self._session._execute(commands)
+
+
+class _RateLimiter():
+    """ Spaces out units of work so that at most rate are done per second,
+        across all of the threads sharing the limiter. No limit if rate is
+        None.
+
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self, units):
+        if self.rate is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + units / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def _container_entity(entity1):
+    """ The Entity subclass of entity1, which may be wrapped in a container """
     if type(entity1) is set:
         for element in entity1:
             entity = element
@@ -26,6 +1081,11 @@ def _set_relation(entity1, field1, entity2):
         entity = entity1
     else:
         raise TypeError('Unknown entity type')
+    return entity
+
+
+def _set_relation(entity1, field1, entity2):
+    entity = _container_entity(entity1)
     if (field1 in entity.fields):
         if (entity1 != entity2):
             raise KeyError('Cannot add relation to existing field')
@@ -59,24 +1119,151 @@ def relate(entityA, fieldA, entityB, fieldB=None):
     *Note that not all n-to-n relationships are sensible.
 
     """
+    if type(entityA) is list or type(entityB) is list:
+        raise TypeError('list fields cannot be related')
+    if fieldB:
+        # a single valued side is a field of the entity's hash
+        for entity, other in ((entityA, entityB), (entityB, entityA)):
+            if (_container_entity(entity).buckets is not None and
+                    type(other) is not set):
+                raise TypeError('bucketed entities cannot relate hash fields')
 
     entity1 = _set_relation(entityA, fieldA, entityB)
     if fieldB:
         entity2 = _set_relation(entityB, fieldB, entityA)
         entity1.relations[fieldA] = (entity2, fieldB)
         entity2.relations[fieldB] = (entity1, fieldA)
+        _compile_fields(entity2)
+    _compile_fields(entity1)
+
+
+class RelatedCollection():
+    """ The entities related to one entity through a relation field, as
+        returned by Entity.related. Nothing is read until the collection is
+        used, and no more ids are read or kept than the page at hand. The
+        requested fields are fetched for one page of page_size entities at a
+        time with a single pipelined round trip of HMGETs.
+
+    for cat in joe.related('cats', prefetch=['age']):
+        cat.prefetched['age']
+    joe.related('cats').page(2)  # the third page, as a list
+    joe.related('cats')[:10]  # slices also hydrate in one round trip
+
+        Iteration walks the related set with SSCAN, so its order is
+        arbitrary and, as with iter_members, an id may be repeated if the
+        set changes meanwhile. Pages and slices are in lexicographic order,
+        each read with SORT ALPHA LIMIT. The entities are built without
+        checking that they exist, and their prefetched dict is a snapshot
+        like the result of load.
+
+    """
+    def __init__(self, owner, spec, prefetch, page_size):
+        if page_size < 1:
+            raise ValueError('page_size must be positive')
+        self.entity = spec.target
+        self.prefetch = list(prefetch)
+        self.page_size = page_size
+        self._owner = owner
+        self._spec = spec
+
+    def _single(self):
+        """ The id held by a single valued relation field, as a list """
+        owner = self._owner
+        value = owner._db.hget(owner._hash, owner._hash_field+self._spec.name)
+        return [value] if value else []
+
+    def ids(self, offset=0, count=None):
+        """ count related ids from offset in lexicographic order, or all of
+            those from offset if count is None.
+
+        """
+        if self._spec.kind != 'set':
+            ids = self._single()[offset:]
+            return ids if count is None else ids[:count]
+        owner = self._owner
+        return owner._db.sort(owner._key+self._spec.suffix, start=offset,
+                              num=-1 if count is None else count, alpha=True)
+
+    def _hydrate(self, ids):
+        db = self._owner._db
+        rows = self.entity.mget(ids, self.prefetch, db, check_exists=False)
+        entities = []
+        for id, row in zip(ids, rows):
+            entity = self.entity(id, db, verify=False)
+            entity.prefetched = row
+            entities.append(entity)
+        return entities
+
+    def pages(self):
+        """ Yield the related entities a page at a time, in SSCAN order """
+        if self._spec.kind == 'set':
+            owner = self._owner
+            batches = _sscan_batches(owner._db, owner._key+self._spec.suffix,
+                                     self.page_size)
+        else:
+            batches = [self._single()]
+        page = []
+        for batch in batches:
+            page.extend(batch)
+            while len(page) >= self.page_size:
+                yield self._hydrate(page[:self.page_size])
+                page = page[self.page_size:]
+        if page:
+            yield self._hydrate(page)
+
+    def page(self, number):
+        """ The related entities of page number, counting from 0 """
+        return self._hydrate(self.ids(number*self.page_size, self.page_size))
+
+    def __iter__(self):
+        for page in self.pages():
+            for entity in page:
+                yield entity
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if ((index.start or 0) < 0 or (index.stop or 0) < 0 or
+                    index.step not in (None, 1)):
+                # negative bounds and steps need the length
+                indices = range(*index.indices(len(self)))
+                if not indices:
+                    return []
+                start, stop = min(indices), max(indices)+1
+                ids = self.ids(start, stop-start)
+                return self._hydrate([ids[i-start] for i in indices])
+            start = index.start or 0
+            if index.stop is None:
+                return self._hydrate(self.ids(start))
+            return self._hydrate(self.ids(start, max(index.stop-start, 0)))
+        if index < 0:
+            index += len(self)
+        ids = self.ids(index, 1) if index >= 0 else []
+        if not ids:
+            raise IndexError('related index out of range')
+        return self._hydrate(ids)[0]
+
+    def __len__(self):
+        if self._spec.kind != 'set':
+            return len(self._single())
+        owner = self._owner
+        return owner._db.scard(owner._key+self._spec.suffix)
 
 
 class _entity_metaclass(type):
 
     def __new__(cls, clsname, bases, attrs):
         if len(bases) > 0:
-            mandatory_fields = ('fields', 'relations', 'lookups')
+            mandatory_fields = ('fields', 'relations', 'lookups',
+                                'range_indexes')
             for field in mandatory_fields:
                 if not field in attrs:
                     attrs[field] = dict()
-        return super(_entity_metaclass, cls).__new__(
+            attrs['_specs'] = dict()
+        entity = super(_entity_metaclass, cls).__new__(
             cls, clsname, bases, attrs)
+        if len(bases) > 0:
+            _compile_fields(entity)
+        return entity
 
 
 class Entity(metaclass=_entity_metaclass):
@@ -165,25 +1352,610 @@ class Entity(metaclass=_entity_metaclass):
 
     """
 
+    # when True, hset, hdel, sadd and srem each run as a single server-side
+    # Lua script, making every mutation one atomic round trip
+    scripted = False
+
+    # an optional ReadCache shared by the reads of this class
+    cache = None
+
+    # the fields fetched for entities yielded by a RelatedCollection
+    prefetched = None
+
+    # when True, the keys of an entity are hash tagged as prefix:{id} and
+    # prefix:{id}:field, so that ShardedRedis keeps them on one node
+    hash_tags = False
+
+    # when set to a number of buckets, the hash fields of all entities and
+    # the entries of injective lookups are packed into that many shared
+    # hashes rather than one key each, see _hash_key
+    buckets = None
+
+    # set by _compile_fields, False once this class or a class related to it
+    # uses hash_tags or buckets
+    _default_layout = True
+
     @classmethod
     def members(cls, db):
         """ List all entities """
         return db.smembers(cls.prefix+'s')
 
+    @classmethod
+    def iter_members(cls, db, count=1000):
+        """ Iterate over all entities without loading them all at once. The
+            set is walked with SSCAN, count is the COUNT hint per call. As
+            with SSCAN, an id may be yielded more than once if the set is
+            modified during iteration.
+
+        """
+        for batch in _sscan_batches(db, cls.prefix+'s', count):
+            for member in batch:
+                yield member
+
     @classmethod
     def exists(cls, id, db):
         """ Returns true if an entity with id id exists on the db """
+        if cls.cache is not None and not isinstance(db, Session):
+            return cls.cache.fetch(('exists', cls.prefix, id),
+                                   [cls.prefix+'s'],
+                                   lambda: db.sismember(cls.prefix+'s', id))
         return db.sismember(cls.prefix+'s', id)
 
     @classmethod
-    def create(cls, id, db):
-        """ Create an object with identifier id on the redis client db """
+    def create(cls, id, db, ttl=None):
+        """ Create an object with identifier id on the redis client db. If
+            ttl is given, the object expires after ttl seconds, see expire.
+
+        """
         if isinstance(id, bytes):
             raise TypeError('id must be a string')
         if cls.exists(id, db):
             raise KeyError(id, 'already exists')
-        db.sadd(cls.prefix + 's', id)
-        return cls(id, db)
+        if ttl is None:
+            db.sadd(cls.prefix + 's', id)
+        else:
+            pipe = db.pipeline(transaction=True)
+            pipe.sadd(cls.prefix + 's', id)
+            pipe.zadd(cls._expiry_key(), {id: time.time()+ttl})
+            pipe.execute()
+        if cls.cache is not None:
+            cls.cache.invalidate(cls.prefix+'s')
+        return cls(id, db, verify=False)
+
+    @classmethod
+    def create_many(cls, ids, db, fields=None, batch_size=1000, ttl=None):
+        """ Create many objects at once. fields is an optional dict mapping
+            an id to a dict of initial hash field values for that id, whose
+            lookups and relations are maintained as in hset. If ttl is given,
+            the objects expire after ttl seconds, as in create.
+
+            ids are processed in batches of batch_size. Each batch costs a
+            WATCH of the id set, one round trip to check existence with
+            SMISMEMBER and one MULTI/EXEC to write, which is retried if an
+            entity of this class was created or deleted in between. A batch
+            is all-or-nothing: if any id in it already exists, KeyError is
+            raised and nothing in it is written, and if two of its ids bind
+            the same side of a 1 to 1 relation, ValueError is raised. Batches
+            before the failing one remain committed.
+
+        """
+        fields = fields or {}
+        ids = list(ids)
+        for id in ids:
+            if not isinstance(id, str):
+                raise TypeError('id must be a string')
+        for id in fields:
+            for field, value in fields[id].items():
+                if not field in cls.fields:
+                    raise TypeError('invalid field: '+field)
+                if not _is_hash_type(cls.fields[field]):
+                    raise TypeError('create_many can only set hash fields')
+        entities = []
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start+batch_size]
+            if len(set(batch)) != len(batch):
+                raise KeyError('duplicate ids in batch')
+            cls._check_claims(batch, fields)
+            while not cls._create_batch(db, batch, fields, ttl):
+                pass
+            entities.extend(cls(id, db, verify=False) for id in batch)
+        return entities
+
+    @classmethod
+    def _check_claims(cls, batch, fields):
+        """ Raise ValueError if the fields of two ids in batch bind the same
+            side of a 1 to 1 relation to different entities. hset would
+            release the earlier claimant, which a single batch cannot do.
+
+        """
+        claims = {}
+        for id in batch:
+            for field, value in fields.get(id, {}).items():
+                spec = cls._specs[field]
+                if spec.related is None or spec.related_set:
+                    continue
+                if isinstance(value, Entity):
+                    value = value.id
+                for side, holder in (((cls, field, id), value),
+                                     ((spec.related, spec.related_field,
+                                       value), id)):
+                    if claims.setdefault(side, holder) != holder:
+                        raise ValueError(side[2]+'\'s '+side[1]+
+                                         ' is claimed twice in batch')
+
+    @classmethod
+    def _create_batch(cls, db, batch, fields, ttl):
+        """ Write one batch of create_many. On a plain client the id set and
+            the 1 to 1 partners read are WATCHed from the existence check to
+            the MULTI/EXEC, so neither an id created nor a partner taken
+            meanwhile by another client is overwritten. Returns False if the
+            transaction was aborted for that reason, in which case nothing
+            was written and the batch should be retried.
+
+        """
+        # keys of 1 to 1 related entities whose current partner needs to be
+        # released, as in hset
+        partner_keys = []
+        for id in batch:
+            for field, value in fields.get(id, {}).items():
+                if field in cls.relations:
+                    other_entity, other_field_name = cls.relations[field]
+                    other_field_type = other_entity.fields[other_field_name]
+                    if type(other_field_type) is not set:
+                        if isinstance(value, Entity):
+                            value = value.id
+                        partner_keys.append((other_entity._entity_key(value),
+                                             other_field_name))
+        # sharded and session pipelines cannot WATCH
+        watch = not isinstance(db, (ShardedRedis, Session))
+        pipe = db.pipeline(transaction=True)
+        try:
+            if watch:
+                # the partners read below are watched too, so a partner
+                # taken meanwhile is not left pointing at two entities
+                pipe.watch(cls.prefix+'s', *set(key for key, _ in
+                                                 partner_keys))
+            reads = db.pipeline(transaction=False)
+            reads.smismember(cls.prefix+'s', batch)
+            for key, name in partner_keys:
+                reads.hget(key, name)
+            results = reads.execute()
+            existing = [id for id, found in zip(batch, results[0]) if found]
+            if existing:
+                raise KeyError(existing, 'already exists')
+            previous_partners = iter(results[1:])
+
+            if watch:
+                pipe.multi()
+            pipe.sadd(cls.prefix+'s', *batch)
+            if ttl is not None:
+                deadline = time.time()+ttl
+                pipe.zadd(cls._expiry_key(), dict((id, deadline)
+                                                  for id in batch))
+            for id in batch:
+                mapping = {}
+                for field, value in fields.get(id, {}).items():
+                    if isinstance(value, Entity):
+                        value = value.id
+                    if field in cls.relations:
+                        other_entity, other_field_name = cls.relations[field]
+                        if type(other_entity.fields[other_field_name]) is set:
+                            pipe.sadd(other_entity._entity_key(value)+':'+
+                                      other_field_name, id)
+                        else:
+                            partner = next(previous_partners)
+                            if partner:
+                                pipe.hdel(cls._entity_key(partner), field)
+                            pipe.hset(other_entity._entity_key(value),
+                                      other_field_name, id)
+                    elif field in cls.lookups:
+                        if cls.lookups[field]:
+                            pipe.hset(*cls._lookup_location(
+                                cls._specs[field], str(value)), value=id)
+                        else:
+                            pipe.sadd(field+':'+str(value)+':'+cls.prefix, id)
+                    if field in cls.range_indexes:
+                        pipe.zadd(cls.range_indexes[field], {id: value})
+                    mapping[cls._hash_prefix(id)+field] = value
+                if mapping:
+                    pipe.hset(cls._hash_key(id), mapping=mapping)
+            try:
+                pipe.execute()
+            except WatchError:
+                return False
+            finally:
+                for id in batch:
+                    cls._invalidate(id, fields.get(id, ()))
+                if cls.cache is not None:
+                    cls.cache.invalidate(cls.prefix+'s')
+            return True
+        finally:
+            if watch:
+                pipe.reset()
+
+    @classmethod
+    def delete_many(cls, ids, db, batch_size=1000):
+        """ Delete many objects at once, cleaning up their related fields and
+            lookups as in delete.
+
+            ids are processed in batches of batch_size. Each batch costs one
+            pipelined round trip to check existence and read the state to
+            clean up, and one MULTI/EXEC to write. If any id in a batch does
+            not exist, KeyError is raised and nothing in that batch is
+            deleted. Batches before the failing one remain committed.
+
+        """
+        ids = list(ids)
+        for start in range(0, len(ids), batch_size):
+            cls._delete_batch(db, ids[start:start+batch_size])
+
+    @classmethod
+    def _delete_batch(cls, db, batch, skip_missing=False):
+        """ Delete the entities of batch with one pipelined read and one
+            MULTI/EXEC, see delete_many. Ids that do not exist raise KeyError
+            unless skip_missing is True, in which case they are left out.
+            Returns the ids deleted.
+
+        """
+        cascade_fields = cls._cascade_fields()
+        pipe = db.pipeline(transaction=False)
+        pipe.smismember(cls.prefix+'s', batch)
+        for id in batch:
+            cls._queue_delete_reads(pipe, id)
+        results = pipe.execute()
+        missing = [id for id, found in zip(batch, results[0]) if not found]
+        if missing and not skip_missing:
+            raise KeyError(missing, 'has not been created yet')
+
+        pipe = db.pipeline(transaction=True)
+        stride = 1 + len(cascade_fields)
+        deleted = []
+        for i, (id, found) in enumerate(zip(batch, results[0])):
+            if not found:
+                continue
+            offset = 1 + i*stride
+            hash_values = results[offset]
+            set_members = dict(zip(cascade_fields,
+                                   results[offset+1:offset+stride]))
+            cls._queue_delete(pipe, id, hash_values, set_members)
+            deleted.append(id)
+        if not deleted:
+            return deleted
+        try:
+            pipe.execute()
+        finally:
+            for id in deleted:
+                cls._invalidate(id, cls.fields)
+            if cls.cache is not None:
+                cls.cache.invalidate(cls.prefix+'s')
+        return deleted
+
+    @classmethod
+    def _expiry_key(cls):
+        """ The sorted set of expiring ids, scored by their deadline """
+        return cls.prefix+'s_expiry'
+
+    @classmethod
+    def reap(cls, db, batch_size=100, now=None):
+        """ Delete up to batch_size entities whose ttl has passed, cleaning
+            up their lookups and relations as in delete_many, and return
+            their ids. Each id is claimed with ZREM before it is deleted, so
+            several reapers can run at once without deleting an entity
+            twice. See Reaper for running this periodically.
+
+            Expired entities remain readable until they are reaped, and an
+            entity may be reaped even if expire is called on it while it is
+            overdue.
+
+        """
+        key = cls._expiry_key()
+        now = time.time() if now is None else now
+        due = db.zrangebyscore(key, '-inf', now, start=0, num=batch_size)
+        if not due:
+            return []
+        pipe = db.pipeline(transaction=False)
+        for id in due:
+            pipe.zrem(key, id)
+        claimed = [id for id, removed in zip(due, pipe.execute()) if removed]
+        if claimed:
+            cls._delete_batch(db, claimed, skip_missing=True)
+        return claimed
+
+    @classmethod
+    def mget(cls, ids, fields, db, check_exists=True):
+        """ Fetch the hash fields of many entities in one pipelined round
+            trip. Returns a list of dicts in the same order as ids, decoded as
+            in load.
+
+            If check_exists is True, existence is verified with a single
+            SMISMEMBER in the same pipeline and ids that do not exist yield
+            None rather than raising, so the rest of the batch is unaffected.
+
+        """
+        ids = list(ids)
+        fields = list(fields)
+        for field in fields:
+            if not field in cls.fields:
+                raise TypeError('invalid field: '+field)
+            if not _is_hash_type(cls.fields[field]):
+                raise TypeError('mget can only fetch hash fields')
+        if not ids:
+            return []
+        pipe = db.pipeline(transaction=False)
+        if check_exists:
+            pipe.smismember(cls.prefix+'s', ids)
+        if fields:
+            for id in ids:
+                hash_prefix = cls._hash_prefix(id)
+                pipe.hmget(cls._hash_key(id),
+                           [hash_prefix+field for field in fields])
+        results = pipe.execute()
+        found = results.pop(0) if check_exists else [True]*len(ids)
+        if not fields:
+            results = [[]]*len(ids)
+        rows = []
+        for exists, raw in zip(found, results):
+            if exists:
+                rows.append(dict((field, cls._specs[field].decode(value))
+                                 for field, value in zip(fields, raw)))
+            else:
+                rows.append(None)
+        return rows
+
+    @classmethod
+    def export(cls, db, stream, batch_size=1000):
+        """ Write every entity of this class to the text stream as NDJSON: a
+            header line naming the prefix, then one line per entity holding
+            its id and the raw values of its hash fields, the members of its
+            set fields, the (member, score) pairs of its sorted set fields and
+            the elements of its list fields. Unset fields are left out.
+
+            Ids are read with SSCAN, and the fields of each batch of
+            batch_size entities are read in one pipelined round trip, so
+            memory use does not depend on the number of entities. Returns a
+            dict with the number of entities written, the seconds taken and
+            the entities per second.
+
+        """
+        start = time.perf_counter()
+        set_fields = [name for name, spec in cls._specs.items()
+                      if spec.kind == 'set']
+        zset_fields = [name for name, spec in cls._specs.items()
+                       if spec.kind == 'zset']
+        list_fields = [name for name, spec in cls._specs.items()
+                       if spec.kind == 'list']
+        stream.write(json.dumps({'prefix': cls.prefix})+'\n')
+        count = 0
+        for batch in _sscan_batches(db, cls.prefix+'s', batch_size):
+            pipe = db.pipeline(transaction=False)
+            for id in batch:
+                key = cls._entity_key(id)
+                cls._queue_hash_read(pipe, id)
+                for field in set_fields:
+                    pipe.smembers(key+':'+field)
+                for field in zset_fields:
+                    pipe.zrange(key+':'+field, 0, -1, withscores=True)
+                for field in list_fields:
+                    pipe.lrange(key+':'+field, 0, -1)
+            results = iter(pipe.execute())
+            for id in batch:
+                row = {'id': id}
+                fields = cls._hash_values(id, next(results))
+                if fields:
+                    row['fields'] = fields
+                sets = dict((field, sorted(next(results)))
+                            for field in set_fields)
+                sets = dict(item for item in sets.items() if item[1])
+                if sets:
+                    row['sets'] = sets
+                zsets = dict((field, [list(pair) for pair in next(results)])
+                             for field in zset_fields)
+                zsets = dict(item for item in zsets.items() if item[1])
+                if zsets:
+                    row['zsets'] = zsets
+                lists = dict((field, next(results)) for field in list_fields)
+                lists = dict(item for item in lists.items() if item[1])
+                if lists:
+                    row['lists'] = lists
+                stream.write(json.dumps(row)+'\n')
+            count += len(batch)
+        elapsed = time.perf_counter() - start
+        return {'entities': count, 'seconds': elapsed,
+                'per_second': count / elapsed if elapsed else 0.0}
+
+    @classmethod
+    def import_(cls, db, stream, batch_size=1000):
+        """ Create the entities written by export to the text stream, along
+            with their lookups, range indexes and both sides of their
+            relations. Every batch_size entities are written in one pipeline
+            without reading anything first, so the entities should not
+            already exist: existing fields are overwritten, but the lookups
+            and relations of their previous values are not released.
+
+            Returns the same figures as export.
+
+        """
+        start = time.perf_counter()
+        header = json.loads(stream.readline() or '{}')
+        if header.get('prefix') != cls.prefix:
+            raise ValueError('stream holds '+str(header.get('prefix'))+
+                             ' entities, not '+cls.prefix)
+        count = 0
+        batch = []
+        for line in stream:
+            if line.strip():
+                batch.append(json.loads(line))
+            if len(batch) == batch_size:
+                cls._import_batch(db, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            cls._import_batch(db, batch)
+            count += len(batch)
+        if cls.cache is not None:
+            cls.cache.clear()
+        elapsed = time.perf_counter() - start
+        return {'entities': count, 'seconds': elapsed,
+                'per_second': count / elapsed if elapsed else 0.0}
+
+    @classmethod
+    def _import_batch(cls, db, rows):
+        pipe = db.pipeline(transaction=False)
+        pipe.sadd(cls.prefix+'s', *[row['id'] for row in rows])
+        for row in rows:
+            id = row['id']
+            key = cls._entity_key(id)
+            fields = row.get('fields', {})
+            for field, value in fields.items():
+                spec = cls._specs.get(field) or _invalid_field(field)
+                cls._queue_bind(pipe, spec, id, value)
+                if spec.range_key is not None:
+                    pipe.zadd(spec.range_key, {id: value})
+            if fields:
+                hash_prefix = cls._hash_prefix(id)
+                pipe.hset(cls._hash_key(id), mapping=dict(
+                    (hash_prefix+field, value)
+                    for field, value in fields.items()))
+            for field, members in row.get('sets', {}).items():
+                spec = cls._specs.get(field) or _invalid_field(field)
+                for member in members:
+                    cls._queue_bind(pipe, spec, id, member)
+                pipe.sadd(key+spec.suffix, *members)
+            for field, pairs in row.get('zsets', {}).items():
+                spec = cls._specs.get(field) or _invalid_field(field)
+                pipe.zadd(key+spec.suffix, dict(pairs))
+            for field, values in row.get('lists', {}).items():
+                spec = cls._specs.get(field) or _invalid_field(field)
+                pipe.rpush(key+spec.suffix, *values)
+        pipe.execute()
+
+    @classmethod
+    def _queue_bind(cls, pipe, spec, id, value):
+        """ Queue the writes adding entity id to the inverse relation or to
+            the lookup of value, one of the values of its field spec. The
+            reverse of _queue_release.
+
+        """
+        if spec.related is not None:
+            if spec.related_set:
+                pipe.sadd(spec.related._entity_key(value)+spec.related_suffix,
+                          id)
+            else:
+                pipe.hset(spec.related._entity_key(value), spec.related_field,
+                          id)
+        elif spec.lookup is not None:
+            if spec.lookup:
+                pipe.hset(*cls._lookup_location(spec, value), value=id)
+            else:
+                pipe.sadd(spec.lookup_prefix+value+spec.lookup_suffix, id)
+
+    @classmethod
+    def traverse(cls, ids, path, db, depth=1, max_fanout=None, hydrate=False):
+        """ Walk a relation breadth first from the entities ids, expanding
+            each level of the frontier in a single pipelined round trip.
+            path is either the name of a relation field followed depth times,
+            such as the friends of a Person, or a list of relation fields
+            followed one after the other.
+
+            Returns a list with one set per hop, holding the ids first reached
+            at that hop. Entities are only visited once, so the starting ids
+            and anything seen at an earlier hop are not repeated. If
+            max_fanout is given, at most that many random neighbours of each
+            entity are expanded. With hydrate, lists of unverified entity
+            instances are returned in place of the sets of ids.
+
+        """
+        if isinstance(path, str):
+            path = [path]*depth
+        entity = cls
+        hops = []
+        for field in path:
+            spec = entity._specs.get(field) or _invalid_field(field)
+            if spec.target is None or spec.kind == 'zset':
+                raise TypeError('traverse requires relation fields: '+field)
+            hops.append(spec)
+            entity = spec.target
+
+        frontier = [id.id if isinstance(id, Entity) else id for id in ids]
+        visited = set((cls.prefix, id) for id in frontier)
+        entity = cls
+        levels = []
+        for spec in hops:
+            pipe = db.pipeline(transaction=False)
+            for id in frontier:
+                key = entity._entity_key(id)
+                if spec.kind == 'hash':
+                    pipe.hget(key, spec.name)
+                elif max_fanout is None:
+                    pipe.smembers(key+spec.suffix)
+                else:
+                    pipe.srandmember(key+spec.suffix, max_fanout)
+            entity = spec.target
+            reached = set()
+            for result in pipe.execute() if frontier else []:
+                if spec.kind == 'hash':
+                    result = (result,) if result else ()
+                for id in result:
+                    if not (entity.prefix, id) in visited:
+                        visited.add((entity.prefix, id))
+                        reached.add(id)
+            levels.append(reached)
+            frontier = list(reached)
+
+        if hydrate:
+            return [[spec.target(id, db, verify=False) for id in level]
+                    for spec, level in zip(hops, levels)]
+        return levels
+
+    @classmethod
+    def add_range_index(cls, field):
+        """ Index an int or float field in a sorted set, scored by the field's
+            value, so that entities can be queried by range or rank with
+            range_lookup and top_k. The index is maintained by hset, hdel,
+            hincrby and delete.
+
+        """
+        if not field in cls.fields:
+            raise TypeError('invalid field: '+field)
+        if not cls.fields[field] in (int, float):
+            raise TypeError('range indexes require an int or float field')
+        cls.range_indexes[field] = cls.prefix+'s:'+field
+        _compile_fields(cls)
+
+    @classmethod
+    def range_lookup(cls, field, min, max, db, offset=None, count=None,
+                     withscores=False):
+        """ Return the ids of entities whose field lies between min and max
+            inclusive, ordered by the field's value. min and max may also be
+            '-inf', '+inf', or prefixed with '(' to be exclusive. Use offset
+            and count to page through the results. With withscores, (id,
+            value) pairs are returned instead.
+
+        """
+        spec = cls._specs.get(field) or _invalid_field(field)
+        if spec.range_key is None:
+            raise TypeError('field has no range index: '+field)
+        if count is not None and offset is None:
+            offset = 0
+        results = db.zrangebyscore(spec.range_key, min, max, start=offset,
+                                   num=count, withscores=withscores)
+        if withscores:
+            return [(id, spec.convert(score)) for id, score in results]
+        return results
+
+    @classmethod
+    def top_k(cls, field, k, db, withscores=False):
+        """ Return the ids of the k entities with the largest field values, in
+            descending order. See range_lookup.
+
+        """
+        spec = cls._specs.get(field) or _invalid_field(field)
+        if spec.range_key is None:
+            raise TypeError('field has no range index: '+field)
+        results = db.zrevrange(spec.range_key, 0, k-1, withscores=withscores)
+        if withscores:
+            return [(id, spec.convert(score)) for id, score in results]
+        return results
 
     @classmethod
     def add_lookup(cls, field, injective=True):
@@ -198,185 +1970,910 @@ class Entity(metaclass=_entity_metaclass):
             if subclass.prefix == field:
                 raise AttributeError('lookup field cannot be a prefix for \
                                       any existing entity')
+        if type(cls.fields.get(field)) is list:
+            raise TypeError('list fields cannot have lookups')
         cls.lookups[field] = injective
+        _compile_fields(cls)
 
     @classmethod
-    def instance(cls, id, db):
-        return cls(id, db)
+    def instance(cls, id, db, verify=True):
+        """ Return the object for id. If verify is False the existence check
+            is skipped and no I/O is done, which is useful when the id is
+            already known to be valid. Unverified objects can be checked in
+            bulk later with Entity.verify.
+
+        """
+        return cls(id, db, verify=verify)
+
+    @staticmethod
+    def verify(handles):
+        """ Check that every entity in handles exists, raising KeyError with
+            the missing ids otherwise. Handles are grouped by class and client,
+            and each group is checked with a single SMISMEMBER.
+
+        """
+        groups = {}
+        for handle in handles:
+            key = (handle.__class__, id(handle._db))
+            groups.setdefault(key, (handle._db, []))[1].append(handle.id)
+        missing = []
+        for (entity, _), (db, ids) in groups.items():
+            for entity_id, found in zip(ids, db.smismember(entity.prefix+'s',
+                                                           ids)):
+                if not found:
+                    missing.append(entity_id)
+        if missing:
+            raise KeyError(missing, 'has not been created yet')
 
     @classmethod
-    @check_field
-    def lookup(self, field, value, db):
-        assert field in self.lookups
+    def lookup(cls, field, value, db):
+        spec = cls._specs.get(field) or _invalid_field(field)
+        assert spec.lookup is not None
         # if its injective
-        if self.lookups[field]:
-            return db.hget(field+':'+value, self.prefix)
+        cache = None if isinstance(db, Session) else cls.cache
+        if spec.lookup:
+            key, name = cls._lookup_location(spec, value)
+            if cache is not None:
+                return cache.fetch(
+                    ('lookup', key, name),
+                    [key, ('lookup', cls.prefix, field)],
+                    lambda: db.hget(key, name))
+            return db.hget(key, name)
+        else:
+            key = spec.lookup_prefix+value+spec.lookup_suffix
+            if cache is not None:
+                return set(cache.fetch(
+                    ('lookup', key), [key, ('lookup', cls.prefix, field)],
+                    lambda: frozenset(db.smembers(key))))
+            return db.smembers(key)
+
+    @classmethod
+    def _lookup_set(cls, field, value):
+        """ Key of the set of ids matching a non-injective lookup """
+        spec = cls._specs.get(field) or _invalid_field(field)
+        if spec.lookup is not False:
+            raise TypeError('queries require non-injective lookups: '+field)
+        return spec.lookup_prefix+value+spec.lookup_suffix
+
+    @classmethod
+    def query(cls, db, any_of=None, none_of=None, count_only=False,
+              offset=None, count=None, ttl=60, refresh=False, **all_of):
+        """ Find entities by combining non-injective lookups server-side with
+            SINTER, SUNION and SDIFF. Keyword arguments name lookups that must
+            all match, any_of is a list of (field, value) pairs of which at
+            least one must match, and none_of a list of pairs that must not
+            match. Without any positive terms every entity is a candidate.
+
+            Person.query(db, favorite_food='pizza',
+                         any_of=[('favorite_songs', 'prelude'),
+                                 ('favorite_songs', 'nocturne')])
+
+            Returns the set of matching ids, or their number if count_only.
+            When offset or count is given, a page of the matching ids in
+            lexicographic order is returned instead. The full result is then
+            kept server-side for ttl seconds, so that the pages after the
+            first reuse it rather than recomputing the query. The first page,
+            offset 0, always recomputes it, as does any page with refresh.
+
+        """
+        all_keys = [cls._lookup_set(field, value)
+                    for field, value in sorted(all_of.items())]
+        any_keys = [cls._lookup_set(field, value)
+                    for field, value in any_of or ()]
+        none_keys = [cls._lookup_set(field, value)
+                     for field, value in none_of or ()]
+        paged = not count_only and (offset is not None or count is not None)
+        if not any_keys and not none_keys and not paged:
+            keys = all_keys or [cls.prefix+'s']
+            if not count_only:
+                return db.sinter(keys)
+            elif len(keys) == 1:
+                return db.scard(keys[0])
+            else:
+                return db.sintercard(len(keys), keys)
+
+        digest = hashlib.sha1(repr((all_keys, any_keys, none_keys)).encode(
+            'utf-8')).hexdigest()
+        result_key = cls.prefix+'s:query:'+digest
+        offset = offset or 0
+        num = -1 if count is None else count
+        if paged and offset and not refresh:
+            pipe = db.pipeline(transaction=False)
+            pipe.exists(result_key)
+            pipe.sort(result_key, start=offset, num=num, alpha=True)
+            stored, page = pipe.execute()
+            if stored:
+                return page
+
+        pipe = db.pipeline(transaction=True)
+        keys = all_keys
+        if any_keys:
+            pipe.sunionstore(result_key, any_keys)
+            keys = keys + [result_key]
+        pipe.sinterstore(result_key, keys or [cls.prefix+'s'])
+        if none_keys:
+            pipe.sdiffstore(result_key, [result_key] + none_keys)
+        if paged:
+            pipe.expire(result_key, ttl)
+            pipe.sort(result_key, start=offset, num=num, alpha=True)
         else:
-            return db.smembers(field+':'+value+':'+self.prefix)
+            if count_only:
+                pipe.scard(result_key)
+            else:
+                pipe.smembers(result_key)
+            pipe.delete(result_key)
+            return pipe.execute()[-2]
+        return pipe.execute()[-1]
+
+    @classmethod
+    def _invalidate(cls, id, fields):
+        """ Drop cached reads made stale by a write to fields of entity id.
+            Writes to related or lookup fields can change other entities and
+            lookups whose keys are not known here, so those drop the whole
+            family of cached reads of the affected fields.
+
+        """
+        for field in fields:
+            spec = cls._specs[field]
+            if cls.cache is not None:
+                if spec.kind == 'hash':
+                    cls.cache.invalidate(cls._hash_key(id))
+                else:
+                    cls.cache.invalidate(cls._entity_key(id)+spec.suffix)
+                if spec.related is not None or spec.lookup is not None:
+                    cls.cache.invalidate(('field', cls.prefix, field))
+                if spec.lookup is not None:
+                    cls.cache.invalidate(('lookup', cls.prefix, field))
+            if spec.related is not None and spec.related.cache is not None:
+                spec.related.cache.invalidate(
+                    ('field', spec.related.prefix, spec.related_field))
 
-    def delete(self):
+    @classmethod
+    def _cascade_fields(cls):
+        """ Set fields whose members must be read before a delete so that
+            their inverse relations and lookups can be cleaned up.
+
+        """
+        return [name for name, spec in cls._specs.items()
+                if spec.kind == 'set' and (spec.related is not None or
+                                           spec.lookup is not None)]
+
+    @classmethod
+    def _queue_delete_reads(cls, pipe, id):
+        """ Queue the reads needed to delete entity id onto pipe. The results
+            are consumed by _queue_delete, in the same order.
+
+        """
+        cls._queue_hash_read(pipe, id)
+        for field_name in cls._cascade_fields():
+            pipe.smembers(cls._entity_key(id)+':'+field_name)
+
+    @classmethod
+    def _queue_release(cls, pipe, spec, id, value):
+        """ Queue the writes removing entity id from the inverse relation or
+            from the lookup of value, one of the values of its field spec.
+
+        """
+        if spec.related is not None:
+            if spec.related_set:
+                pipe.srem(spec.related._entity_key(value)+spec.related_suffix,
+                          id)
+            else:
+                pipe.hdel(spec.related._entity_key(value), spec.related_field)
+        elif spec.lookup is not None:
+            if spec.lookup:
+                pipe.hdel(*cls._lookup_location(spec, value))
+            else:
+                pipe.srem(spec.lookup_prefix+value+spec.lookup_suffix, id)
+
+    @classmethod
+    def _queue_delete(cls, pipe, id, hash_values, set_members):
+        """ Queue every write needed to delete entity id onto pipe, given the
+            current contents of its hash and of its cascading set fields.
+            Inverse relations and lookups are cleaned up before the entity's
+            own keys so that a partially applied delete can be retried.
+
+        """
+        key = cls._entity_key(id)
+        hash_values = cls._hash_values(id, hash_values)
+        for spec in cls._specs.values():
+            if spec.kind == 'set':
+                for member in set_members.get(spec.name, ()):
+                    cls._queue_release(pipe, spec, id, member)
+                pipe.delete(key+spec.suffix)
+            elif spec.kind in ('zset', 'list'):
+                pipe.delete(key+spec.suffix)
+            else:
+                value = hash_values.get(spec.name)
+                if value:
+                    cls._queue_release(pipe, spec, id, value)
+                if spec.range_key is not None:
+                    pipe.zrem(spec.range_key, id)
+        if cls.buckets is None:
+            pipe.delete(key)
+        else:
+            hash_prefix = cls._hash_prefix(id)
+            pipe.hdel(cls._hash_key(id), *[hash_prefix+field for field, spec
+                                            in cls._specs.items()
+                                            if spec.kind == 'hash'])
+        pipe.zrem(cls._expiry_key(), id)
+        pipe.srem(cls.prefix+'s', id)
+
+    @classmethod
+    def iter_lookup(cls, field, value, db, count=1000):
+        """ Iterate over the ids matching a non-injective lookup using SSCAN,
+            see iter_members.
+
+        """
+        spec = cls._specs.get(field) or _invalid_field(field)
+        assert spec.lookup is not None
+        if spec.lookup:
+            raise TypeError('iter_lookup requires a non-injective lookup')
+        for batch in _sscan_batches(db, spec.lookup_prefix+value+
+                                    spec.lookup_suffix, count):
+            for member in batch:
+                yield member
+
+    @classmethod
+    def lookup_count(cls, field, value, db):
+        """ Number of entities matching a lookup """
+        spec = cls._specs.get(field) or _invalid_field(field)
+        assert spec.lookup is not None
+        if spec.lookup:
+            return int(db.hexists(*cls._lookup_location(spec, value)))
+        else:
+            return db.scard(spec.lookup_prefix+value+spec.lookup_suffix)
+
+    @classmethod
+    def lookup_sample(cls, field, value, db, k):
+        """ Return up to k distinct random ids matching a non-injective lookup
+        """
+        spec = cls._specs.get(field) or _invalid_field(field)
+        assert spec.lookup is not None
+        if spec.lookup:
+            raise TypeError('lookup_sample requires a non-injective lookup')
+        return db.srandmember(spec.lookup_prefix+value+spec.lookup_suffix, k)
+
+    @classmethod
+    def check(cls, db, repair=False, workers=4, batch_size=500, max_rate=None,
+              scan_lookups=True, max_samples=100):
+        """ Verify that the lookups, range indexes and inverse relations of
+            every entity of this class agree with its fields, and fix them if
+            repair is True. Meant to run online after a crash may have left
+            some of the writes of an hset, sadd or srem undone.
+
+            Ids are read with SSCAN in batches of batch_size, which are
+            checked concurrently by a pool of workers threads with pipelined
+            reads, so each batch costs a few round trips. max_rate caps the
+            entities checked per second. With scan_lookups, the lookup keys
+            are also walked with SCAN to find entries whose entity no longer
+            holds the value. Bucketed lookups are skipped in that pass.
+
+            The fields of the entity are the reference. Missing lookup entries
+            and range index scores are written, and missing inverse relations
+            are added, unless the inverse is a single valued field already
+            bound to another entity. In that case the single valued field
+            wins and the value is removed from this entity's set, or, if both
+            sides are single valued, the conflict is only reported. Values
+            naming entities that do not exist are removed. An injective
+            lookup bound to another entity is reported only.
+
+            Returns a dict with the number of entities checked, problems found
+            and problems repaired, and up to max_samples problems as (id,
+            field, value, description) tuples.
+
+        """
+        report = {'checked': 0, 'problems': 0, 'repaired': 0, 'samples': []}
+        lock = threading.Lock()
+        limiter = _RateLimiter(max_rate)
+
+        def _account(checked, problems, repaired):
+            with lock:
+                report['checked'] += checked
+                report['problems'] += len(problems)
+                report['repaired'] += repaired
+                room = max_samples - len(report['samples'])
+                report['samples'].extend(problems[:max(room, 0)])
+
+        # the commands of the workers are counted in a record of their own
+        # and then added to the instrumented record of this call, if any
+        record = getattr(_current, 'record', None)
+
+        def _run(batch):
+            limiter.wait(len(batch))
+            if record is None:
+                problems, repaired = cls._check_batch(db, batch, repair)
+            else:
+                worker = _current.record = OpRecord(record.entity,
+                                                    record.method)
+                try:
+                    problems, repaired = cls._check_batch(db, batch, repair)
+                finally:
+                    _current.record = None
+                    with lock:
+                        for counter in OpRecord._counters:
+                            setattr(record, counter, getattr(record, counter)
+                                    + getattr(worker, counter))
+            _account(len(batch), problems, repaired)
+
+        with ThreadPoolExecutor(workers) as pool:
+            pending = deque()
+            for batch in _sscan_batches(db, cls.prefix+'s', batch_size):
+                pending.append(pool.submit(_run, batch))
+                # bound the number of batches held in memory
+                while len(pending) > 2*workers:
+                    pending.popleft().result()
+            while pending:
+                pending.popleft().result()
+        if scan_lookups and cls.buckets is None:
+            for spec in cls._specs.values():
+                if spec.lookup is not None:
+                    problems, repaired = cls._check_lookup_keys(
+                        db, spec, repair, batch_size, limiter)
+                    _account(0, problems, repaired)
+        return report
+
+    @classmethod
+    def _check_batch(cls, db, ids, repair):
+        """ Check the entities ids, see check. Returns the problems found and
+            the number repaired.
+
+        """
+        specs = [spec for spec in cls._specs.values()
+                 if spec.related is not None or spec.lookup is not None]
+        set_specs = [spec for spec in specs if spec.kind == 'set']
+        range_specs = [spec for spec in cls._specs.values()
+                       if spec.range_key is not None]
+        pipe = db.pipeline(transaction=False)
+        for id in ids:
+            cls._queue_hash_read(pipe, id)
+            for spec in set_specs:
+                pipe.smembers(cls._entity_key(id)+spec.suffix)
+            for spec in range_specs:
+                pipe.zscore(spec.range_key, id)
+        results = iter(pipe.execute())
+
+        problems = []
+        fixes = db.pipeline(transaction=False)
+        fixed = 0
+        # (id, spec, value) for every value that needs a lookup or inverse
+        expected = []
+        for id in ids:
+            values = cls._hash_values(id, next(results))
+            for spec in specs:
+                if spec.kind == 'hash':
+                    if values.get(spec.name):
+                        expected.append((id, spec, values[spec.name]))
+                else:
+                    for member in next(results):
+                        expected.append((id, spec, member))
+            for spec in range_specs:
+                score = next(results)
+                value = values.get(spec.name)
+                if value is None and score is not None:
+                    problems.append((id, spec.name, None, 'stale index score'))
+                    fixes.zrem(spec.range_key, id)
+                    fixed += 1
+                elif value is not None and score != float(value):
+                    problems.append((id, spec.name, value,
+                                     'wrong index score'))
+                    fixes.zadd(spec.range_key, {id: value})
+                    fixed += 1
+
+        pipe = db.pipeline(transaction=False)
+        for id, spec, value in expected:
+            if spec.related is not None:
+                pipe.sismember(spec.related.prefix+'s', value)
+                if spec.related_set:
+                    pipe.sismember(spec.related._entity_key(value)+
+                                   spec.related_suffix, id)
+                else:
+                    pipe.hget(spec.related._entity_key(value),
+                              spec.related_field)
+            elif spec.lookup:
+                pipe.hget(*cls._lookup_location(spec, value))
+            else:
+                pipe.sismember(spec.lookup_prefix+value+spec.lookup_suffix,
+                               id)
+        results = iter(pipe.execute())
+
+        for id, spec, value in expected:
+            if spec.related is not None and not next(results):
+                next(results)
+                problems.append((id, spec.name, value,
+                                 'related entity does not exist'))
+                if spec.kind == 'set':
+                    fixes.srem(cls._entity_key(id)+spec.suffix, value)
+                else:
+                    fixes.hdel(cls._hash_key(id), cls._hash_prefix(id)+
+                               spec.name)
+                fixed += 1
+                continue
+            found = next(results)
+            # whether the inverse or lookup is a single valued hash field
+            single = (spec.lookup if spec.related is None else
+                      not spec.related_set)
+            if not found:
+                problems.append((id, spec.name, value, 'missing inverse'
+                                 if spec.related else 'missing lookup'))
+                cls._queue_bind(fixes, spec, id, value)
+                fixed += 1
+            elif single and found != id:
+                if spec.related is not None and spec.kind == 'set':
+                    problems.append((id, spec.name, value,
+                                     'inverse bound to '+found))
+                    fixes.srem(cls._entity_key(id)+spec.suffix, value)
+                    fixed += 1
+                else:
+                    problems.append((id, spec.name, value,
+                                     'conflicts with '+found))
+        if not repair:
+            return problems, 0
+        if fixed:
+            fixes.execute()
+        return problems, fixed
+
+    @classmethod
+    def _check_lookup_keys(cls, db, spec, repair, batch_size, limiter):
+        """ Find the entries of the lookup of spec whose entity does not hold
+            the value, see check.
+
+        """
+        if spec.lookup:
+            pattern, key_type = spec.lookup_prefix+'*', 'hash'
+        else:
+            pattern, key_type = (spec.lookup_prefix+'*'+spec.lookup_suffix,
+                                 'set')
+        problems = []
+        repaired = 0
+        keys = db.scan_iter(match=pattern, count=batch_size, _type=key_type)
+        while True:
+            batch = [key for _, key in zip(range(batch_size), keys)]
+            if not batch:
+                return problems, repaired
+            limiter.wait(len(batch))
+            pipe = db.pipeline(transaction=False)
+            for key in batch:
+                if spec.lookup:
+                    pipe.hget(key, cls.prefix)
+                else:
+                    pipe.smembers(key)
+            # (lookup key, value, id) for every entry
+            entries = []
+            for key, result in zip(batch, pipe.execute()):
+                value = key[len(spec.lookup_prefix):]
+                if not spec.lookup:
+                    value = value[:len(value)-len(spec.lookup_suffix)]
+                for id in [result] if spec.lookup else result:
+                    if id:
+                        entries.append((key, value, id))
+            pipe = db.pipeline(transaction=False)
+            for key, value, id in entries:
+                if spec.kind == 'hash':
+                    pipe.hget(cls._hash_key(id), cls._hash_prefix(id)+
+                              spec.name)
+                else:
+                    pipe.sismember(cls._entity_key(id)+spec.suffix, value)
+            fixes = db.pipeline(transaction=False)
+            stale = 0
+            for (key, value, id), held in zip(entries, pipe.execute()):
+                if held == value if spec.kind == 'hash' else held:
+                    continue
+                problems.append((id, spec.name, value, 'stale lookup'))
+                if spec.lookup:
+                    fixes.hdel(key, cls.prefix)
+                else:
+                    fixes.srem(key, id)
+                stale += 1
+            if repair and stale:
+                fixes.execute()
+                repaired += stale
+
+    def delete(self, chunk_size=None):
         """ Remove this entity from the db, all associated fields and related
-            fields will also be cleaned up
-
-        """
-        for field_name, field_type in self.fields.items():
-            if type(field_type) is set:
-                if field_name in self.relations or field_name in self.lookups:
-                    for member in self._db.smembers(self.prefix+':'+self.id
-                                                    +':'+field_name):
-                        self.srem(field_name, member)
-                self._db.delete(self.prefix+':'+self.id+':'+field_name)
-            elif type(field_type) is zset:
-                self._db.delete(self.prefix+':'+self.id+':'+field_name)
-            elif issubclass(field_type, Entity):
-                self.hdel(field_name)
-            elif field_type in (str, int, bool, float):
-                self.hdel(field_name)
-        self._db.delete(self.prefix+':'+self.id)
-        self._db.srem(self.prefix+'s', self.id)
+            fields will also be cleaned up.
+
+            The entity's hash and cascading sets are read in one round trip,
+            and all of the cleanup is then applied in a single MULTI/EXEC. If
+            chunk_size is given, the cleanup is instead sent in transactions
+            of at most chunk_size commands, which bounds the size of each
+            request at the cost of atomicity across chunks.
+
+        """
+        pipe = self._db.pipeline(transaction=False)
+        self._queue_delete_reads(pipe, self.id)
+        results = pipe.execute()
+        hash_values = results[0]
+        set_members = dict(zip(self._cascade_fields(), results[1:]))
+        if chunk_size is None:
+            pipe = self._db.pipeline(transaction=True)
+        else:
+            pipe = _ChunkedPipeline(self._db, chunk_size)
+        self._queue_delete(pipe, self.id, hash_values, set_members)
+        try:
+            pipe.execute()
+        finally:
+            self._invalidate(self.id, self.fields)
+            if self.cache is not None:
+                self.cache.invalidate(self.prefix+'s')
+
+    def expire(self, ttl):
+        """ Delete this entity, with its lookups and relations, once ttl
+            seconds have passed. Deletion is done by reap, so the entity
+            lives until a reaper runs after the deadline. Calling expire
+            again replaces the deadline.
+
+        """
+        self._db.zadd(self._expiry_key(), {self._id: time.time()+ttl})
+
+    def persist(self):
+        """ Cancel the expiry of this entity, returning True if it had one """
+        return bool(self._db.zrem(self._expiry_key(), self._id))
+
+    def ttl(self):
+        """ Seconds left before this entity expires, or None if it does not
+            expire. Overdue entities that have not been reaped yet return 0.
+
+        """
+        deadline = self._db.zscore(self._expiry_key(), self._id)
+        if deadline is None:
+            return None
+        return max(deadline - time.time(), 0.0)
+
+    def __getattr__(self, name):
+        # the keys of this entity are built on first use and then stored, so
+        # that constructing a handle costs no more than it did before the key
+        # layout became configurable. _key is the key of the entity's hash,
+        # which prefixes all of its other keys, and _hash and _hash_field
+        # locate its hash fields, which differs for bucketed entities.
+        if name == '_key':
+            value = self._entity_key(str(self._id))
+        elif name == '_hash':
+            value = self._hash_key(str(self._id))
+        elif name == '_hash_field':
+            value = self._hash_prefix(str(self._id))
+        else:
+            raise AttributeError(name)
+        self.__dict__[name] = value
+        return value
 
     @property
     def id(self):
         return self._id
 
-    @check_field
+    @classmethod
+    def _entity_key(cls, id):
+        """ Key of the hash of entity id, which prefixes its other keys """
+        if cls.hash_tags:
+            return cls.prefix+':{'+id+'}'
+        return cls.prefix+':'+id
+
+    def _use_scripts(self):
+        """ True if mutations should run as Lua scripts. The scripts derive
+            the keys of related entities and lookups themselves, so they need
+            the default key layout and every key on one server.
+
+        """
+        return (self.scripted and self._default_layout and
+                not isinstance(self._db, (ShardedRedis, Session)))
+
+    @classmethod
+    def _hash_key(cls, id):
+        """ Key of the hash holding the hash fields of entity id. Bucketed
+            entities share it, and prefix their fields with _hash_prefix(id).
+
+        """
+        if cls.buckets is None:
+            return cls._entity_key(id)
+        return cls.prefix+'#'+str(_bucket(id, cls.buckets))
+
+    @classmethod
+    def _hash_prefix(cls, id):
+        return '' if cls.buckets is None else id+':'
+
+    @classmethod
+    def _lookup_location(cls, spec, value):
+        """ Key and hash field of the entry of value in an injective lookup """
+        if cls.buckets is None:
+            return spec.lookup_prefix+value, cls.prefix
+        return (spec.name+'#'+str(_bucket(value, cls.buckets)),
+                value+':'+cls.prefix)
+
+    @classmethod
+    def _queue_hash_read(cls, pipe, id):
+        """ Queue a read of every hash field of entity id, whose result is
+            decoded by _hash_values.
+
+        """
+        if cls.buckets is None:
+            pipe.hgetall(cls._entity_key(id))
+        else:
+            hash_prefix = cls._hash_prefix(id)
+            pipe.hmget(cls._hash_key(id), [hash_prefix+field for field, spec
+                                           in cls._specs.items()
+                                           if spec.kind == 'hash'])
+
+    @classmethod
+    def _hash_values(cls, id, raw):
+        """ Map field names to the raw values read by _queue_hash_read """
+        if cls.buckets is None:
+            return raw
+        return dict((field, value) for field, value in
+                    zip([field for field, spec in cls._specs.items()
+                         if spec.kind == 'hash'], raw) if value is not None)
+
+    @classmethod
+    def _script_args(cls, id, field, values):
+        """ ARGV for one of the mutation scripts on field of entity id """
+        spec = cls._specs[field]
+        return [cls.prefix, id, field] + spec.script_spec + list(values)
+
+    def _run_script(self, script, key, spec, values):
+        """ Run one of the mutation scripts on the field of this entity """
+        keys = [key] if spec.range_key is None else [key, spec.range_key]
+        return script(self._db, keys, [self.prefix, self._id, spec.name] +
+                      spec.script_spec + values)
+
+    @classmethod
+    def _sadd_values(cls, field, values):
+        """ Convert the values passed to sadd to strings """
+        derived_entity = cls._specs[field].member_type
+        carbon_copy_values = []
+        for value in values:
+            if isinstance(value, AsyncEntity):
+                value_type = value.entity
+            else:
+                value_type = type(value)
+            if (issubclass(value_type, derived_entity) and
+                    issubclass(value_type, Entity)):
+                carbon_copy_values.append(value.id)
+            elif type(value) == str:
+                carbon_copy_values.append(value)
+            else:
+                raise TypeError('Bad sadd type')
+        return carbon_copy_values
+
     def hincrby(self, field, count=1):
         """ Increment the field by count, field must be declared int """
-        if self.fields[field] != int:
+        spec = self._specs.get(field) or _invalid_field(field)
+        if spec.member_type is not int or spec.kind != 'hash':
             raise TypeError('cannot call hincrby on a non-int field')
-        return self._db.hincrby(self.prefix + ':' + self._id, field, count)
+        try:
+            if spec.range_key is None:
+                return self._db.hincrby(self._hash, self._hash_field+field,
+                                        count)
+            pipe = self._db.pipeline(transaction=True)
+            pipe.hincrby(self._hash, self._hash_field+field, count)
+            pipe.zincrby(spec.range_key, count, self._id)
+            return pipe.execute()[0]
+        finally:
+            if self.cache is not None:
+                self._invalidate(self._id, (field,))
 
-    @check_field
     def hset(self, field, value):
         """ Set a hash field equal to value """
-        # set local value
-        assert (self.fields[field] in (str, int, bool, float) or
-                issubclass(self.fields[field], Entity))
-
-        # clean up this field first since it can only be bound to a single
-        # object hash field (implicitly).
-        if field in self.relations:
-            self.hdel(field)
-            assert isinstance(value, Entity)
-            other_entity = self.relations[field][0]
-            other_field_name = self.relations[field][1]
-            other_field_type = other_entity.fields[other_field_name]
-            if type(other_field_type) is set:
-                self._db.sadd(other_entity.prefix+':'+value.id+':'+
-                              other_field_name, self.id)
-            elif issubclass(other_field_type, Entity):
-                # raise?
-                value.hdel(other_field_name)
-                self._db.hset(other_entity.prefix+':'+value.id,
-                              other_field_name, self.id)
-            self.hdel(field)
-        elif field in self.lookups:
-            self.hdel(field)
-            if self.lookups[field]:
-                # see if this field is mapped to something already
-                reference = self.__class__.lookup(field, value, self._db)
-                if reference:
-                    self._db.hdel(self.prefix+':'+reference+':'+field, value)
-                self._db.hset(field+':'+value, self.prefix, self.id)
+        spec = self._specs.get(field) or _invalid_field(field)
+        assert spec.kind == 'hash'
+        try:
+            if self._use_scripts():
+                if spec.related is not None:
+                    assert isinstance(value, Entity)
+                if isinstance(value, Entity):
+                    value = value.id
+                self._run_script(_HSET_SCRIPT, self._key, spec, [value])
+                return
+
+            # clean up this field first since it can only be bound to a
+            # single object hash field (implicitly).
+            if spec.related is not None:
+                self.hdel(field)
+                assert isinstance(value, Entity)
+                if spec.related_set:
+                    self._db.sadd(spec.related._entity_key(value.id)+
+                                  spec.related_suffix, self._id)
+                else:
+                    # raise?
+                    spec.related(value.id, self._db, verify=False).hdel(
+                        spec.related_field)
+                    self._db.hset(spec.related._entity_key(value.id),
+                                  spec.related_field, self._id)
+                self.hdel(field)
+            elif spec.lookup is not None:
+                self.hdel(field)
+                if spec.lookup:
+                    # see if this field is mapped to something already
+                    reference = self.__class__.lookup(field, value, self._db)
+                    if reference:
+                        self._db.hdel(self._entity_key(reference)+spec.suffix,
+                                      value)
+                    self._db.hset(*self._lookup_location(spec, value),
+                                  value=self._id)
+                else:
+                    self._db.sadd(spec.lookup_prefix+value+spec.lookup_suffix,
+                                  self._id)
+            if isinstance(value, Entity):
+                value = value.id
+            if spec.range_key is None:
+                self._db.hset(self._hash, self._hash_field+field, value)
             else:
-                self._db.sadd(field+':'+value+':'+self.prefix, self.id)
-        if isinstance(value, Entity):
-            value = value.id
-        self._db.hset(self.prefix + ':' + self._id, field, value)
+                pipe = self._db.pipeline(transaction=True)
+                pipe.hset(self._hash, self._hash_field+field, value)
+                pipe.zadd(spec.range_key, {self._id: value})
+                pipe.execute()
+        finally:
+            if self.cache is not None or spec.related is not None:
+                self._invalidate(self._id, (field,))
 
-    @check_field
     def hdel(self, field):
         """ Delete a hash field and its related fields and lookups """
-        assert (self.fields[field] in (str, int, bool, float) or
-                issubclass(self.fields[field], Entity))
-
-        if field in self.relations:
-        #if issubclass(self.fields[field], Entity):
-            other_entity = self.relations[field][0]
-            other_field_name = self.relations[field][1]
-            other_field_type = other_entity.fields[other_field_name]
-            other_entity_id = self._db.hget(self.prefix+':'+self.id, field)
-            if other_entity_id:
-                if type(other_field_type) is set:
-                    self._db.srem(other_entity.prefix+':'+other_entity_id+':'+
-                                  other_field_name, self.id)
-                elif issubclass(other_field_type, Entity):
-                    self._db.hdel(other_entity.prefix+':'+other_entity_id,
-                                  other_field_name)
-        elif field in self.lookups:
-            lookup_value = self._db.hget(self.prefix+':'+self.id, field)
-            if lookup_value:
-                # if it is injective, implies mapping to a single hash
-                if self.lookups[field]:
-                    self._db.hdel(field+':'+lookup_value, self.prefix)
-                # lookup maps to many different values
-                else:
-                    self._db.srem(field+':'+lookup_value+':'+self.prefix,
-                                  self.id)
+        spec = self._specs.get(field) or _invalid_field(field)
+        assert spec.kind == 'hash'
+        try:
+            if self._use_scripts():
+                self._run_script(_HDEL_SCRIPT, self._key, spec, [])
+                return
+
+            if spec.related is not None or spec.lookup is not None:
+                value = self._db.hget(self._hash, self._hash_field+field)
+                if value:
+                    self._queue_release(self._db, spec, self._id, value)
+            if spec.range_key is not None:
+                self._db.zrem(spec.range_key, self._id)
+            self._db.hdel(self._hash, self._hash_field+field)
+        finally:
+            if self.cache is not None or spec.related is not None:
+                self._invalidate(self._id, (field,))
 
-        self._db.hdel(self.prefix+':'+self.id, field)
-
-    @check_field
     def hget(self, field):
         """ Get a hash field """
-        field_type = self.fields[field]
-        if (field_type in (str, int, bool, float)):
-            val = self._db.hget(self.prefix + ':' + self._id, field)
-            if val:
-                return field_type(val)
-            else:
-                return val
-        elif issubclass(field_type, Entity):
-            return self._db.hget(self.prefix+':'+self._id, field)
-        else:
+        spec = self._specs.get(field) or _invalid_field(field)
+        if spec.kind != 'hash':
             raise TypeError('Unknown type')
+        if self.cache is not None:
+            return self.cache.fetch(
+                ('hget', self._hash, self._hash_field+field),
+                [self._hash, ('field', self.prefix, field)],
+                lambda: spec.decode(self._db.hget(self._hash,
+                                                  self._hash_field+field)))
+        value = self._db.hget(self._hash, self._hash_field+field)
+        if value and spec.convert is not None:
+            return spec.convert(value)
+        return value
 
-    @check_field
     def smembers(self, field):
         """ Return members of a set """
-        if type(self.fields[field]) != set:
+        spec = self._specs.get(field) or _invalid_field(field)
+        if spec.kind != 'set':
             raise KeyError('called smembers on non-set field')
-        set_values = set()
-        for member in self._db.smembers(self.prefix + ':' + self._id + ':' +
-                                        field):
-            for primitive_type in self.fields[field]:
-                if issubclass(primitive_type, Entity):
-                    set_values.add(member)
-                elif primitive_type in (str, int, bool, float):
-                    set_values.add(primitive_type(member))
-                else:
-                    raise TypeError('Unknown field type')
-        return set_values
+        key = self._key+spec.suffix
+        if self.cache is not None:
+            return set(self.cache.fetch(
+                ('smembers', key), [key, ('field', self.prefix, field)],
+                lambda: frozenset(spec.decode_members(
+                    self._db.smembers(key)))))
+        return spec.decode_members(self._db.smembers(key))
+
+    def load(self, fields=None, collections=False):
+        """ Fetch many fields of this entity in a single round trip and
+            return them as a dict keyed by field name, decoded according to
+            fields. Unset hash fields are returned as None.
+
+            If fields is None, every hash field is fetched with one HGETALL,
+            and set and sorted set fields are included when collections is
+            True. Otherwise only the named fields are fetched, using HMGET for
+            the hash fields. Sets are returned as sets, lists as lists and
+            sorted sets as a list of (member, score) pairs in ascending order
+            of score. All of the commands are sent in one pipeline.
+
+        """
+        specs = self._specs
+        if fields is None:
+            hash_fields = None
+            collection_fields = [name for name, spec in specs.items()
+                                 if collections and spec.kind != 'hash']
+        else:
+            for field in fields:
+                if not field in specs:
+                    _invalid_field(field)
+            hash_fields = [f for f in fields if specs[f].kind == 'hash']
+            collection_fields = [f for f in fields if specs[f].kind != 'hash']
+        pipe = self._db.pipeline(transaction=False)
+        if hash_fields is None:
+            self._queue_hash_read(pipe, self._id)
+        elif hash_fields:
+            pipe.hmget(self._hash, [self._hash_field+field
+                                    for field in hash_fields])
+        for field in collection_fields:
+            if specs[field].kind == 'set':
+                pipe.smembers(self._key+specs[field].suffix)
+            elif specs[field].kind == 'list':
+                pipe.lrange(self._key+specs[field].suffix, 0, -1)
+            else:
+                pipe.zrange(self._key+specs[field].suffix, 0, -1,
+                            withscores=True)
+        results = iter(pipe.execute())
+
+        values = {}
+        if hash_fields is None:
+            raw = self._hash_values(self._id, next(results))
+            for field, spec in specs.items():
+                if spec.kind == 'hash':
+                    values[field] = spec.decode(raw.get(field))
+        elif hash_fields:
+            for field, raw in zip(hash_fields, next(results)):
+                values[field] = specs[field].decode(raw)
+        for field in collection_fields:
+            spec = specs[field]
+            if spec.kind == 'set':
+                values[field] = spec.decode_members(next(results))
+            elif spec.kind == 'list':
+                values[field] = spec.decode_list(next(results))
+            else:
+                values[field] = spec.decode_pairs(next(results))
+        return values
+
+    def related(self, field, prefetch=(), page_size=100):
+        """ Return a lazy RelatedCollection of the entities related to this
+            one through field, whose prefetch fields are fetched in one
+            round trip per page as they are iterated. This avoids both the
+            existence check of building each related entity and a round
+            trip per field read.
+
+        """
+        spec = self._specs.get(field) or _invalid_field(field)
+        if spec.target is None or spec.kind == 'zset':
+            raise TypeError(field+' is not a relation')
+        for name in prefetch:
+            other = spec.target._specs.get(name) or _invalid_field(name)
+            if other.kind != 'hash':
+                raise TypeError('only hash fields can be prefetched')
+        return RelatedCollection(self, spec, prefetch, page_size)
+
+    def iter_smembers(self, field, count=1000):
+        """ Iterate over the members of a set field using SSCAN, decoding each
+            batch as in smembers. See iter_members.
+
+        """
+        spec = self._specs.get(field) or _invalid_field(field)
+        if spec.kind != 'set':
+            raise KeyError('called iter_smembers on non-set field')
+        for batch in _sscan_batches(self._db, self._key+spec.suffix, count):
+            for member in spec.decode_members(batch):
+                yield member
 
-    @check_field
     def sismember(self, field, value):
+        spec = self._specs.get(field) or _invalid_field(field)
         if isinstance(value, Entity):
             value = value.id
-        return self._db.sismember(self.prefix+':'+self.id+':'+field, value)
+        return self._db.sismember(self._key+spec.suffix, value)
 
-    @check_field
     def scard(self, field):
-        return self._db.scard(self.prefix+':'+self.id+':'+field)
+        spec = self._specs.get(field) or _invalid_field(field)
+        return self._db.scard(self._key+spec.suffix)
 
-    @check_field
     def srandmember(self, field):
-        return self._db.srandmember(self.prefix+':'+self.id+':'+field)
+        spec = self._specs.get(field) or _invalid_field(field)
+        return self._db.srandmember(self._key+spec.suffix)
 
-    @check_field
     def sremall(self, field):
         """ Empty the set """
-        assert type(self.fields[field]) == set
+        spec = self._specs.get(field) or _invalid_field(field)
+        assert spec.kind == 'set'
 
-        if field in self.relations or field in self.lookups:
+        if spec.related is not None or spec.lookup is not None:
             values = list(self.smembers(field))
             self.srem(field, *values)
         else:
-            self._db.delete(self.prefix+':'+self._id+':'+field)
+            try:
+                self._db.delete(self._key+spec.suffix)
+            finally:
+                if self.cache is not None:
+                    self._invalidate(self._id, (field,))
 
-    @check_field
     def srem(self, field, *values):
         """ Remove values from the set field """
-        assert type(self.fields[field]) == set
+        spec = self._specs.get(field) or _invalid_field(field)
+        assert spec.kind == 'set'
         carbon_copy_values = []
         for value in values:
             if isinstance(value, Entity):
@@ -384,112 +2881,940 @@ class Entity(metaclass=_entity_metaclass):
             else:
                 carbon_copy_values.append(value)
 
-        for value in carbon_copy_values:
-            if field in self.relations:
-                if not self.sismember(field, value):
-                    raise ValueError(value+' is not in '+self.id+'\'s '+field)
-                other_entity = self.relations[field][0]
-                other_field_name = self.relations[field][1]
-                other_field_type = other_entity.fields[other_field_name]
-
-                if type(other_field_type) is set:
-                    self._db.srem(other_entity.prefix+':'+value+':'+
-                                  other_field_name, self.id)
-                elif issubclass(other_field_type, Entity):
-                    self._db.hdel(other_entity.prefix+':'+value,
-                                  other_field_name)
-            elif field in self.lookups:
-                if not self.sismember(field, value):
-                    raise ValueError(value+' is not in '+self.id+'\'s '+field)
-                if self.lookups[field]:
-                    # see if this field mapped to something already
-                    self._db.hdel(field+':'+value, self.prefix, self.id)
-                else:
-                    self._db.srem(field+':'+value+':'+self.prefix, self.id)
-
-        self._db.srem(self.prefix+':'+self._id+':'+field, *carbon_copy_values)
+        try:
+            if self._use_scripts():
+                self._run_script(_SREM_SCRIPT, self._key+spec.suffix, spec,
+                                 carbon_copy_values)
+                return
+
+            if spec.related is None and spec.lookup is None:
+                self._db.srem(self._key+spec.suffix, *carbon_copy_values)
+                return
+
+            # validate every value in one round trip before writing anything
+            found = self._db.smismember(self._key+spec.suffix,
+                                        carbon_copy_values)
+            for value, present in zip(carbon_copy_values, found):
+                if not present:
+                    raise ValueError(value+' is not in '+self._id+'\'s '+
+                                     field)
+            pipe = self._db.pipeline(transaction=True)
+            for value in carbon_copy_values:
+                self._queue_release(pipe, spec, self._id, value)
+            pipe.srem(self._key+spec.suffix, *carbon_copy_values)
+            pipe.execute()
+        finally:
+            if self.cache is not None or spec.related is not None:
+                self._invalidate(self._id, (field,))
 
-    @check_field
     def sadd(self, field, *values):
         """ Add values to the field. If the field expects Entities, then values
         can either be a list of strings, a list of Entities, or a mix of both.
 
         """
-        assert type(self.fields[field]) == set
-        for key in self.fields[field]:
-            derived_entity = key
-        carbon_copy_values = []
+        spec = self._specs.get(field) or _invalid_field(field)
+        assert spec.kind == 'set'
         # convert all values to strings first
-        for value in values:
-            if isinstance(value, derived_entity) and isinstance(value, Entity):
-                carbon_copy_values.append(value.id)
-            elif type(value) == str:
-                carbon_copy_values.append(value)
+        carbon_copy_values = self._sadd_values(field, values)
+
+        try:
+            if self._use_scripts():
+                self._run_script(_SADD_SCRIPT, self._key+spec.suffix, spec,
+                                 carbon_copy_values)
+                return
+
+            # read what the new values are currently bound to in one round
+            # trip, then apply all of the writes in a single transaction
+            previous = ()
+            if spec.related is not None and not spec.related_set:
+                other_entity = spec.related
+                pipe = self._db.pipeline(transaction=False)
+                pipe.smismember(other_entity.prefix+'s', carbon_copy_values)
+                for value in carbon_copy_values:
+                    pipe.hget(other_entity._entity_key(value),
+                              spec.related_field)
+                results = pipe.execute()
+                missing = [value for value, found in
+                           zip(carbon_copy_values, results[0]) if not found]
+                if missing:
+                    raise KeyError(missing, 'has not been created yet')
+                previous = results[1:]
+            elif spec.lookup:
+                pipe = self._db.pipeline(transaction=False)
+                for value in carbon_copy_values:
+                    pipe.hget(*self._lookup_location(spec, value))
+                previous = pipe.execute()
+
+            pipe = self._db.pipeline(transaction=True)
+            if spec.related is not None:
+                other_spec = spec.related._specs[spec.related_field]
+                for value, reference in zip(carbon_copy_values, previous):
+                    if reference:
+                        spec.related._queue_release(pipe, other_spec, value,
+                                                    reference)
+                for value in carbon_copy_values:
+                    if spec.related_set:
+                        pipe.sadd(spec.related._entity_key(value)+
+                                  spec.related_suffix, self._id)
+                    else:
+                        pipe.hset(spec.related._entity_key(value),
+                                  spec.related_field, self._id)
+            elif spec.lookup is not None:
+                for value, reference in zip(carbon_copy_values, previous):
+                    if reference:
+                        pipe.srem(self._entity_key(reference)+spec.suffix,
+                                  value)
+                for value in carbon_copy_values:
+                    if spec.lookup:
+                        pipe.hset(*self._lookup_location(spec, value),
+                                  value=self._id)
+                    else:
+                        pipe.sadd(spec.lookup_prefix+value+spec.lookup_suffix,
+                                  self._id)
+            pipe.sadd(self._key+spec.suffix, *carbon_copy_values)
+            pipe.execute()
+        finally:
+            if self.cache is not None or spec.related is not None:
+                self._invalidate(self._id, (field,))
+
+    @classmethod
+    def _queue_push(cls, pipe, command, key, values, maxlen):
+        """ Queue an RPUSH or LPUSH of values onto the list at key, followed
+            by the LTRIM that caps it at maxlen elements if maxlen is given.
+
+        """
+        if not values:
+            raise ValueError('nothing to push')
+        getattr(pipe, command)(key, *values)
+        if maxlen is not None:
+            if maxlen < 1:
+                raise ValueError('maxlen must be positive')
+            if command == 'rpush':
+                pipe.ltrim(key, -maxlen, -1)
             else:
-                raise TypeError('Bad sadd type')
+                pipe.ltrim(key, 0, maxlen-1)
+
+    def _push(self, command, field, values, maxlen):
+        spec = self._specs.get(field) or _invalid_field(field)
+        if spec.kind != 'list':
+            raise KeyError('called '+command+' on non-list field')
+        pipe = self._db.pipeline(transaction=maxlen is not None)
+        self._queue_push(pipe, command, self._key+spec.suffix, values, maxlen)
+        length = pipe.execute()[0]
+        if length is None or maxlen is None:
+            return length
+        return min(length, maxlen)
+
+    def rpush(self, field, *values, maxlen=None):
+        """ Append values to the end of a list field and return its length.
+            With maxlen, the list is trimmed to its last maxlen elements in
+            the same MULTI/EXEC, which keeps logs bounded.
 
-        if field in self.relations:
-            other_entity = self.relations[field][0]
-            other_field_name = self.relations[field][1]
-            other_field_type = other_entity.fields[other_field_name]
-            for value in carbon_copy_values:
-                if type(other_field_type) is set:
-                    self._db.sadd(other_entity.prefix+':'+value+':'+
-                                  other_field_name, self.id)
-                elif issubclass(other_field_type, Entity):
-                    other_entity(value, self._db).hdel(other_field_name)
-                    self._db.hset(other_entity.prefix+':'+value,
-                                  other_field_name, self.id)
-        elif field in self.lookups:
-            for value in carbon_copy_values:
-                if self.lookups[field]:
-                    # see if this field mapped to something already
-                    reference = self.__class__.lookup(field, value, self._db)
-                    if reference:
-                        self._db.srem(self.prefix+':'+reference+':'+field,
-                                      value)
-                    self._db.hset(field+':'+value, self.prefix, self.id)
-                else:
-                    self._db.sadd(field+':'+value+':'+self.prefix, self.id)
+        """
+        return self._push('rpush', field, values, maxlen)
 
-        self._db.sadd(self.prefix+':'+self._id+':'+field, *carbon_copy_values)
+    def lpush(self, field, *values, maxlen=None):
+        """ Prepend values to a list field one at a time, so they end up in
+            reverse order, and return its length. With maxlen, only the
+            first maxlen elements are kept, see rpush.
 
-    @check_field
-    def zscore(self, field, key):
-        assert type(self.fields[field] == zset)
-        return self._db.zscore(self.prefix+':'+self.id+':'+field, key)
+        """
+        return self._push('lpush', field, values, maxlen)
+
+    def lrange(self, field, start=0, stop=-1):
+        """ Return the elements of a list field between start and stop
+            inclusive, decoded according to fields.
 
-    @check_field
-    def zrange(self, field, start, stop):
-        assert type(self.fields[field] == zset)
-        return self._db.zrange(self.prefix+':'+self.id+':'+field, start, stop)
+        """
+        spec = self._specs.get(field) or _invalid_field(field)
+        if spec.kind != 'list':
+            raise KeyError('called lrange on non-list field')
+        return spec.decode_list(self._db.lrange(self._key+spec.suffix, start,
+                                                stop))
+
+    def iter_lrange(self, field, count=1000):
+        """ Iterate over the elements of a list field in order, fetching
+            count of them per LRANGE so that long lists are never read in one
+            reply. Elements appended meanwhile are included, while elements
+            pushed onto the head shift the remaining ones and may be seen
+            twice.
+
+        """
+        spec = self._specs.get(field) or _invalid_field(field)
+        if spec.kind != 'list':
+            raise KeyError('called iter_lrange on non-list field')
+        key = self._key+spec.suffix
+        start = 0
+        while True:
+            batch = self._db.lrange(key, start, start+count-1)
+            for value in spec.decode_list(batch):
+                yield value
+            if len(batch) < count:
+                break
+            start += count
+
+    def llen(self, field):
+        spec = self._specs.get(field) or _invalid_field(field)
+        if spec.kind != 'list':
+            raise KeyError('called llen on non-list field')
+        return self._db.llen(self._key+spec.suffix)
+
+    def _zset_key(self, field, command):
+        spec = self._specs.get(field) or _invalid_field(field)
+        if spec.kind != 'zset':
+            raise KeyError('called '+command+' on non-zset field')
+        return spec, self._key+spec.suffix
+
+    @staticmethod
+    def _zadd_mapping(args):
+        """ The member to score mapping of the arguments given to zadd: a
+            single dict, or alternating members and scores.
+
+        """
+        if len(args) == 1 and isinstance(args[0], dict):
+            return args[0]
+        if len(args) % 2:
+            raise TypeError('zadd takes a mapping or member, score pairs')
+        return dict(zip(args[::2], args[1::2]))
+
+    def zscore(self, field, member):
+        spec, key = self._zset_key(field, 'zscore')
+        return self._db.zscore(key, member)
+
+    def zcard(self, field):
+        spec, key = self._zset_key(field, 'zcard')
+        return self._db.zcard(key)
+
+    def zrange(self, field, start, stop, withscores=False):
+        """ Return the members of a sorted set field ranked between start and
+            stop inclusive, lowest score first, decoded according to fields.
+            With withscores, (member, score) pairs are returned instead.
+
+        """
+        spec, key = self._zset_key(field, 'zrange')
+        if withscores:
+            return spec.decode_pairs(self._db.zrange(key, start, stop,
+                                                     withscores=True))
+        return spec.decode_list(self._db.zrange(key, start, stop))
+
+    def zrevrange(self, field, start, stop, withscores=False):
+        """ As zrange, but ranked from the highest score """
+        spec, key = self._zset_key(field, 'zrevrange')
+        if withscores:
+            return spec.decode_pairs(self._db.zrevrange(key, start, stop,
+                                                        withscores=True))
+        return spec.decode_list(self._db.zrevrange(key, start, stop))
+
+    def zrangebyscore(self, field, min, max, offset=None, count=None,
+                      withscores=False):
+        """ Return the members of a sorted set field whose score lies between
+            min and max inclusive, lowest first. min and max may also be
+            '-inf', '+inf', or prefixed with '(' to be exclusive. Use offset
+            and count to page, or iter_zrangebyscore for large ranges.
+
+        """
+        spec, key = self._zset_key(field, 'zrangebyscore')
+        result = self._db.zrangebyscore(key, min, max, start=offset,
+                                        num=count, withscores=withscores)
+        if withscores:
+            return spec.decode_pairs(result)
+        return spec.decode_list(result)
+
+    def iter_zrangebyscore(self, field, min='-inf', max='+inf', count=1000,
+                           withscores=False):
+        """ Iterate over the members of a sorted set field whose score lies
+            between min and max, lowest first, fetching count of them per
+            round trip. Each page resumes from the last score seen rather
+            than from an offset, so the cost of a page does not grow with
+            the number of pages already read.
+
+        """
+        spec, key = self._zset_key(field, 'iter_zrangebyscore')
+        skip = 0
+        while True:
+            batch = self._db.zrangebyscore(key, min, max, start=skip,
+                                           num=count, withscores=True)
+            for member, score in spec.decode_pairs(batch):
+                yield (member, score) if withscores else member
+            if len(batch) < count:
+                break
+            last = batch[-1][1]
+            tied = len([pair for pair in batch if pair[1] == last])
+            # members sharing the last score are skipped by offset, and
+            # accumulate if the whole page had the score resumed from
+            skip = skip + tied if min == last else tied
+            min = last
 
-    @check_field
     def zremrangebyrank(self, field, start, stop):
-        assert type(self.fields[field] == zset)
-        return self._db.zremrangebyrank(self.prefix+':'+self.id+':'+field,
-                                        start, stop)
-
-    @check_field
-    def zadd(self, field, *args, **kwargs):
-        assert type(self.fields[field] == zset)
-        assert not field in self.lookups
-        assert not field in self.relations
-        return self._db.zadd(self.prefix+':'+self.id+':'+field, *args,
-                             **kwargs)
-
-    @check_field
-    def zrem(self, field, *args):
-        assert type(self.fields[field] == zset)
-        assert not field in self.lookups
-        assert not field in self.relations
-        return self._db.zrem(self.prefix+':'+self.id+':'+field, *args)
+        spec, key = self._zset_key(field, 'zremrangebyrank')
+        return self._db.zremrangebyrank(key, start, stop)
 
-    def __init__(self, id, db):
+    def zadd(self, field, *args, nx=False, xx=False, ch=False):
+        """ Add members to a sorted set field, given either as a dict of
+            member to score or as alternating members and scores, in one
+            ZADD. nx, xx and ch are passed on to ZADD. Returns the number of
+            members added.
+
+        """
+        spec, key = self._zset_key(field, 'zadd')
+        assert spec.lookup is None
+        assert spec.related is None
+        mapping = self._zadd_mapping(args)
+        if not mapping:
+            return 0
+        return self._db.zadd(key, mapping, nx=nx, xx=xx, ch=ch)
+
+    def zincrby(self, field, member, amount=1):
+        """ Increment the score of member by amount and return the new
+            score, adding member if it is missing.
+
+        """
+        spec, key = self._zset_key(field, 'zincrby')
+        return self._db.zincrby(key, amount, member)
+
+    def zrem(self, field, *members):
+        spec, key = self._zset_key(field, 'zrem')
+        assert spec.lookup is None
+        assert spec.related is None
+        return self._db.zrem(key, *members)
+
+    def zpopmin(self, field, count=1):
+        """ Remove and return up to count (member, score) pairs with the
+            lowest scores, which lets several consumers take batches off a
+            queue without handing out the same member twice.
+
+        """
+        spec, key = self._zset_key(field, 'zpopmin')
+        return spec.decode_pairs(self._db.zpopmin(key, count))
+
+    def __init__(self, id, db, verify=True):
         assert type(id) in (str, int)
         self._db = db
         self._id = id
+        if isinstance(db, Session):
+            # a session's reads must not be cached, as they include writes
+            # that are not flushed yet
+            self.cache = None
         # overhead
-        if not self.__class__.exists(id, db):
+        if verify and not self.__class__.exists(id, db):
             raise KeyError(id, 'has not been created yet')
         self.__dict__['_id'] = id
+
+
+class Reaper():
+    """ Deletes expired entities in the background. Every interval seconds,
+        each of entities reaps at most max_batches batches of batch_size
+        entities, so the work done per tick is bounded however many are
+        overdue; the rest are left for later ticks.
+
+    reaper = apollo.Reaper(db, [Session, Job], interval=1.0)
+    reaper.start()  # in a daemon thread
+    ...
+    reaper.stop()
+
+    task = asyncio.ensure_future(reaper.serve())  # or as an asyncio task
+
+        serve runs each tick in the event loop's default executor, as the
+        entities are reaped with the blocking client db.
+
+    """
+    def __init__(self, db, entities, interval=1.0, batch_size=100,
+                 max_batches=10):
+        if batch_size < 1 or max_batches < 1:
+            raise ValueError('batch_size and max_batches must be positive')
+        self.db = db
+        self.entities = list(entities)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def tick(self):
+        """ Reap each entity class once and return the number of ids reaped
+        """
+        reaped = 0
+        for entity in self.entities:
+            for _ in range(self.max_batches):
+                ids = entity.reap(self.db, self.batch_size)
+                reaped += len(ids)
+                if len(ids) < self.batch_size:
+                    break
+        return reaped
+
+    def _safe_tick(self):
+        try:
+            return self.tick()
+        except Exception:
+            logging.getLogger('apollo').exception('reaper tick failed')
+            return 0
+
+    def start(self):
+        """ Run ticks in a daemon thread until stop is called """
+        if self._thread is not None:
+            raise RuntimeError('reaper already started')
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='apollo-reaper')
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._safe_tick()
+            self._stopped.wait(self.interval)
+
+    def stop(self, timeout=None):
+        """ Stop the thread started by start, or the serve coroutine """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    async def serve(self):
+        """ Run ticks until stop is called or the task is cancelled """
+        loop = asyncio.get_running_loop()
+        self._stopped.clear()
+        while not self._stopped.is_set():
+            await loop.run_in_executor(None, self._safe_tick)
+            await asyncio.sleep(self.interval)
+
+
+class OpRecord():
+    """ What one Entity operation cost: its wall time in seconds, the redis
+        commands it issued, the round trips they took, and approximate bytes
+        sent and received. Operations called by another one, such as the hdel
+        done by hset, are counted in the outer operation.
+
+    """
+    __slots__ = ('entity', 'method', 'seconds', 'commands', 'round_trips',
+                 'bytes_sent', 'bytes_received', 'error')
+
+    # the counters a nested record adds to the record of its operation
+    _counters = ('commands', 'round_trips', 'bytes_sent', 'bytes_received')
+
+    def __init__(self, entity, method):
+        self.entity = entity
+        self.method = method
+        self.seconds = 0.0
+        self.commands = 0
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.error = False
+
+    def __repr__(self):
+        return ('<OpRecord {0}.{1} {2:.6f}s {3} commands {4} round trips>'
+                .format(self.entity, self.method, self.seconds, self.commands,
+                        self.round_trips))
+
+
+class Instrumentation():
+    """ Collects an OpRecord for every Entity operation once enabled with
+        apollo.instrument(), aggregated per entity class and method:
+
+    stats = apollo.Instrumentation(slow_threshold=0.01)
+    apollo.instrument(stats)
+    ...
+    stats.stats()['Person']['hset']  # calls, commands, latency histogram...
+    apollo.instrument(None)
+
+        Operations slower than slow_threshold seconds are kept in slow_ops,
+        the most recent slow_log_size of them, and logged to the 'apollo'
+        logger. Every record is also passed to each of exporters, callables
+        run on the thread of the operation. Only operations on synchronous
+        redis clients are counted. The commands check issues from its
+        worker threads are counted towards the check.
+
+    """
+    # upper bounds in seconds of the latency histogram buckets, the last
+    # bucket counts everything slower
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self, slow_threshold=None, slow_log_size=100, exporters=()):
+        self.slow_threshold = slow_threshold
+        self.slow_ops = deque(maxlen=slow_log_size)
+        self.exporters = list(exporters)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, record):
+        """ Account for a finished operation """
+        with self._lock:
+            methods = self._stats.setdefault(record.entity, {})
+            if not record.method in methods:
+                methods[record.method] = {
+                    'calls': 0, 'errors': 0, 'seconds': 0.0,
+                    'max_seconds': 0.0, 'commands': 0, 'round_trips': 0,
+                    'bytes_sent': 0, 'bytes_received': 0,
+                    'histogram': [0]*(len(self.buckets)+1)}
+            stats = methods[record.method]
+            stats['calls'] += 1
+            stats['errors'] += record.error
+            stats['seconds'] += record.seconds
+            stats['max_seconds'] = max(stats['max_seconds'], record.seconds)
+            stats['commands'] += record.commands
+            stats['round_trips'] += record.round_trips
+            stats['bytes_sent'] += record.bytes_sent
+            stats['bytes_received'] += record.bytes_received
+            stats['histogram'][bisect.bisect_left(self.buckets,
+                                                  record.seconds)] += 1
+        if (self.slow_threshold is not None and
+                record.seconds >= self.slow_threshold):
+            self.slow_ops.append(record)
+            logging.getLogger('apollo').warning('slow operation: %r', record)
+        for exporter in self.exporters:
+            exporter(record)
+
+    def stats(self):
+        """ A copy of the aggregates, keyed by entity class name and then by
+            method name.
+
+        """
+        with self._lock:
+            return dict((entity, dict((method, dict(stats, histogram=list(
+                stats['histogram']))) for method, stats in methods.items()))
+                for entity, methods in self._stats.items())
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+        self.slow_ops.clear()
+
+
+# the enabled Instrumentation, the operation being recorded on each thread,
+# and the functions replaced while instrumentation is enabled
+_instrumentation = None
+_current = threading.local()
+_originals = {}
+
+
+def _size(value):
+    """ Approximate number of bytes value takes on the wire """
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_size(k) + _size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sum(_size(item) for item in value)
+    if value is None:
+        return 0
+    return len(str(value))
+
+
+def _instrumented(name, func, binding):
+    """ Wrap the Entity method func so that it produces an OpRecord. binding
+        is the kind of method: classmethod, staticmethod or a plain function.
+        Static methods are recorded under Entity.
+
+    """
+    @wraps(func)
+    def _wrapper(*args, **kwargs):
+        if getattr(_current, 'record', None) is not None:
+            return func(*args, **kwargs)
+        if binding is classmethod:
+            entity = args[0]
+        elif binding is staticmethod:
+            entity = Entity
+        else:
+            entity = type(args[0])
+        record = OpRecord(entity.__name__, name)
+        _current.record = record
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            record.error = True
+            raise
+        finally:
+            record.seconds = time.perf_counter() - start
+            _current.record = None
+            instrumentation = _instrumentation
+            if instrumentation is not None:
+                instrumentation.record(record)
+    return _wrapper
+
+
+def _counted_command(original):
+    @wraps(original)
+    def _execute_command(self, *args, **options):
+        record = getattr(_current, 'record', None)
+        if record is None:
+            return original(self, *args, **options)
+        result = original(self, *args, **options)
+        record.commands += 1
+        record.round_trips += 1
+        record.bytes_sent += _size(args)
+        record.bytes_received += _size(result)
+        return result
+    return _execute_command
+
+
+def _counted_pipeline(original):
+    @wraps(original)
+    def _execute(self, *args, **kwargs):
+        record = getattr(_current, 'record', None)
+        if record is None:
+            return original(self, *args, **kwargs)
+        stack = self.command_stack
+        record.commands += len(stack)
+        record.round_trips += 1 if stack else 0
+        record.bytes_sent += sum(_size(command[0]) for command in stack)
+        result = original(self, *args, **kwargs)
+        record.bytes_received += _size(result)
+        return result
+    return _execute
+
+
+def instrument(instrumentation):
+    """ Record every Entity operation in instrumentation, or stop recording
+        if it is None. While disabled, which is the default, the Entity
+        methods and redis client are the original, unwrapped functions, so
+        instrumentation costs nothing.
+
+        Enabling wraps the public methods of Entity, static methods included,
+        except for generators
+        and schema methods, and counts commands by wrapping
+        redis.Redis.execute_command and redis.client.Pipeline.execute.
+
+    """
+    global _instrumentation
+    import redis.client
+    if instrumentation is not None and _instrumentation is None:
+        for name, attr in list(Entity.__dict__.items()):
+            if (name.startswith('_') or name.startswith('add_') or
+                    not isinstance(attr, (classmethod, staticmethod,
+                                          type(instrument)))):
+                continue
+            binding = type(attr)
+            func = attr if binding is type(instrument) else attr.__func__
+            if inspect.isgeneratorfunction(func):
+                continue
+            _originals[(Entity, name)] = attr
+            wrapper = _instrumented(name, func, binding)
+            setattr(Entity, name, wrapper if binding is type(instrument)
+                    else binding(wrapper))
+        for cls, name, wrap in (
+                (redis.client.Redis, 'execute_command', _counted_command),
+                (redis.client.Pipeline, 'execute', _counted_pipeline)):
+            _originals[(cls, name)] = cls.__dict__[name]
+            setattr(cls, name, wrap(cls.__dict__[name]))
+    elif instrumentation is None:
+        for (cls, name), attr in _originals.items():
+            setattr(cls, name, attr)
+        _originals.clear()
+    _instrumentation = instrumentation
+
+
+class AsyncEntity():
+    """ asyncio counterpart of an Entity subclass, for use with a
+        redis.asyncio client. The schema (prefix, fields, relations and
+        lookups) is shared with the Entity subclass, so fields declared and
+        relations and lookups added to it apply unchanged:
+
+    APerson = apollo.AsyncEntity.of(Person)
+    joe = await APerson.create('joe', db)
+    await joe.hset('ssn', '123-45-6789')
+    await APerson.lookup('ssn', '123-45-6789', db)  # returns 'joe'
+
+        Every mutation that maintains relations or lookups runs as the same
+        server-side script used by Entity.scripted, so it is one atomic round
+        trip regardless of the entity's scripted setting. Multi-key reads are
+        pipelined, and independent calls can be fanned out with
+        asyncio.gather.
+
+    """
+
+    # the Entity subclass whose schema is used, set by AsyncEntity.of
+    entity = None
+
+    _wrappers = {}
+
+    @staticmethod
+    def of(entity):
+        """ Return the AsyncEntity class for the Entity subclass entity """
+        if not entity._default_layout:
+            raise TypeError('only the default key layout has an asyncio API')
+        if not entity in AsyncEntity._wrappers:
+            AsyncEntity._wrappers[entity] = type(
+                'Async'+entity.__name__, (AsyncEntity,),
+                {'entity': entity, 'prefix': entity.prefix,
+                 'fields': entity.fields, 'relations': entity.relations,
+                 'lookups': entity.lookups, '_specs': entity._specs})
+        return AsyncEntity._wrappers[entity]
+
+    def __init__(self, id, db):
+        """ Build an object for id without checking that it exists, use
+            instance() to check.
+
+        """
+        assert type(id) in (str, int)
+        self._db = db
+        self._id = id
+
+    @property
+    def id(self):
+        return self._id
+
+    @classmethod
+    async def members(cls, db):
+        """ List all entities """
+        return await db.smembers(cls.prefix+'s')
+
+    @classmethod
+    async def exists(cls, id, db):
+        """ Returns true if an entity with id id exists on the db """
+        return await db.sismember(cls.prefix+'s', id)
+
+    @classmethod
+    async def create(cls, id, db):
+        """ Create an object with identifier id on the redis client db """
+        if isinstance(id, bytes):
+            raise TypeError('id must be a string')
+        if not await db.sadd(cls.prefix+'s', id):
+            raise KeyError(id, 'already exists')
+        if cls.entity.cache is not None:
+            cls.entity.cache.invalidate(cls.prefix+'s')
+        return cls(id, db)
+
+    @classmethod
+    async def instance(cls, id, db, verify=True):
+        if verify and not await cls.exists(id, db):
+            raise KeyError(id, 'has not been created yet')
+        return cls(id, db)
+
+    @classmethod
+    async def lookup(cls, field, value, db):
+        spec = cls._specs.get(field) or _invalid_field(field)
+        assert spec.lookup is not None
+        if spec.lookup:
+            return await db.hget(*cls.entity._lookup_location(spec, value))
+        else:
+            return await db.smembers(spec.lookup_prefix+value+
+                                     spec.lookup_suffix)
+
+    @classmethod
+    async def mget(cls, ids, fields, db, check_exists=True):
+        """ Fetch the hash fields of many entities in one pipeline, see
+            Entity.mget.
+
+        """
+        ids = list(ids)
+        fields = list(fields)
+        for field in fields:
+            spec = cls._specs.get(field) or _invalid_field(field)
+            if spec.kind != 'hash':
+                raise TypeError('mget can only fetch hash fields')
+        if not ids:
+            return []
+        entity = cls.entity
+        pipe = db.pipeline(transaction=False)
+        if check_exists:
+            pipe.smismember(cls.prefix+'s', ids)
+        if fields:
+            for id in ids:
+                hash_prefix = entity._hash_prefix(id)
+                pipe.hmget(entity._hash_key(id),
+                           [hash_prefix+field for field in fields])
+        results = await pipe.execute()
+        found = results.pop(0) if check_exists else [True]*len(ids)
+        if not fields:
+            results = [[]]*len(ids)
+        rows = []
+        for exists, raw in zip(found, results):
+            if exists:
+                rows.append(dict((field, cls._specs[field].decode(value))
+                                 for field, value in zip(fields, raw)))
+            else:
+                rows.append(None)
+        return rows
+
+    async def delete(self):
+        """ Remove this entity from the db, cleaning up its related fields and
+            lookups with one pipelined read and one MULTI/EXEC, see
+            Entity.delete.
+
+        """
+        entity = self.entity
+        pipe = self._db.pipeline(transaction=False)
+        entity._queue_delete_reads(pipe, self.id)
+        results = await pipe.execute()
+        set_members = dict(zip(entity._cascade_fields(), results[1:]))
+        pipe = self._db.pipeline(transaction=True)
+        entity._queue_delete(pipe, self.id, results[0], set_members)
+        try:
+            await pipe.execute()
+        finally:
+            entity._invalidate(self.id, self.fields)
+            if entity.cache is not None:
+                entity.cache.invalidate(self.prefix+'s')
+
+    def _spec(self, field, kind):
+        """ The spec of field, which must be of the given kind """
+        spec = self._specs.get(field) or _invalid_field(field)
+        if spec.kind != kind:
+            raise TypeError(field+' is not a '+kind+' field')
+        return spec
+
+    def _field_key(self, spec):
+        """ Key of the set, list or sorted set field of this entity """
+        return self.entity._entity_key(str(self._id))+spec.suffix
+
+    def _hash_location(self, field):
+        """ Key and hash field holding the hash field of this entity """
+        id = str(self._id)
+        return (self.entity._hash_key(id),
+                self.entity._hash_prefix(id)+field)
+
+    async def _run_script(self, script, spec, values):
+        # the layout is checked here rather than only in of, since a class
+        # related later on may use hash tags or buckets
+        entity = self.entity
+        if not entity._default_layout:
+            raise TypeError('only the default key layout has an asyncio API')
+        key = entity._entity_key(self.id)
+        if spec.kind == 'set':
+            key += spec.suffix
+        keys = [key] if spec.range_key is None else [key, spec.range_key]
+        try:
+            return await script.acall(self._db, keys, entity._script_args(
+                self.id, spec.name, values))
+        finally:
+            entity._invalidate(self.id, [spec.name])
+
+    async def hget(self, field):
+        """ Get a hash field """
+        spec = self._specs.get(field) or _invalid_field(field)
+        if spec.kind != 'hash':
+            raise TypeError('Unknown type')
+        return spec.decode(await self._db.hget(*self._hash_location(field)))
+
+    async def hset(self, field, value):
+        """ Set a hash field equal to value """
+        spec = self._spec(field, 'hash')
+        if spec.related is not None:
+            assert isinstance(value, (Entity, AsyncEntity))
+        if isinstance(value, (Entity, AsyncEntity)):
+            value = value.id
+        await self._run_script(_HSET_SCRIPT, spec, [value])
+
+    async def hdel(self, field):
+        """ Delete a hash field and its related fields and lookups """
+        await self._run_script(_HDEL_SCRIPT, self._spec(field, 'hash'), [])
+
+    async def hincrby(self, field, count=1):
+        """ Increment the field by count, field must be declared int """
+        spec = self._specs.get(field) or _invalid_field(field)
+        if spec.member_type is not int or spec.kind != 'hash':
+            raise TypeError('cannot call hincrby on a non-int field')
+        key, name = self._hash_location(field)
+        try:
+            if spec.range_key is None:
+                return await self._db.hincrby(key, name, count)
+            pipe = self._db.pipeline(transaction=True)
+            pipe.hincrby(key, name, count)
+            pipe.zincrby(spec.range_key, count, self._id)
+            return (await pipe.execute())[0]
+        finally:
+            self.entity._invalidate(self.id, [field])
+
+    async def smembers(self, field):
+        """ Return members of a set """
+        spec = self._specs.get(field) or _invalid_field(field)
+        if spec.kind != 'set':
+            raise KeyError('called smembers on non-set field')
+        return spec.decode_members(await self._db.smembers(
+            self._field_key(spec)))
+
+    async def sismember(self, field, value):
+        if isinstance(value, (Entity, AsyncEntity)):
+            value = value.id
+        return await self._db.sismember(
+            self._field_key(self._spec(field, 'set')), value)
+
+    async def scard(self, field):
+        return await self._db.scard(self._field_key(self._spec(field, 'set')))
+
+    async def sadd(self, field, *values):
+        """ Add values to the field, see Entity.sadd """
+        await self._run_script(_SADD_SCRIPT, self._spec(field, 'set'),
+                               self.entity._sadd_values(field, values))
+
+    async def srem(self, field, *values):
+        """ Remove values from the set field """
+        spec = self._spec(field, 'set')
+        values = [value.id if isinstance(value, (Entity, AsyncEntity))
+                  else value for value in values]
+        await self._run_script(_SREM_SCRIPT, spec, values)
+
+    async def rpush(self, field, *values, maxlen=None):
+        """ Append values to a list field, see Entity.rpush """
+        return await self._push('rpush', field, values, maxlen)
+
+    async def lpush(self, field, *values, maxlen=None):
+        """ Prepend values to a list field, see Entity.lpush """
+        return await self._push('lpush', field, values, maxlen)
+
+    async def _push(self, command, field, values, maxlen):
+        spec = self._spec(field, 'list')
+        pipe = self._db.pipeline(transaction=maxlen is not None)
+        self.entity._queue_push(pipe, command, self._field_key(spec), values,
+                                maxlen)
+        length = (await pipe.execute())[0]
+        return length if maxlen is None else min(length, maxlen)
+
+    async def lrange(self, field, start=0, stop=-1):
+        spec = self._spec(field, 'list')
+        return spec.decode_list(await self._db.lrange(
+            self._field_key(spec), start, stop))
+
+    async def llen(self, field):
+        return await self._db.llen(self._field_key(self._spec(field, 'list')))
+
+    async def zscore(self, field, key):
+        return await self._db.zscore(
+            self._field_key(self._spec(field, 'zset')), key)
+
+    async def zrange(self, field, start, stop, withscores=False):
+        spec = self._spec(field, 'zset')
+        result = await self._db.zrange(self._field_key(spec), start, stop,
+                                       withscores=withscores)
+        if withscores:
+            return spec.decode_pairs(result)
+        return spec.decode_list(result)
+
+    async def zrangebyscore(self, field, min, max, offset=None, count=None,
+                            withscores=False):
+        spec = self._spec(field, 'zset')
+        result = await self._db.zrangebyscore(
+            self._field_key(spec), min, max, start=offset, num=count,
+            withscores=withscores)
+        if withscores:
+            return spec.decode_pairs(result)
+        return spec.decode_list(result)
+
+    async def zincrby(self, field, member, amount=1):
+        return await self._db.zincrby(
+            self._field_key(self._spec(field, 'zset')), amount, member)
+
+    async def zpopmin(self, field, count=1):
+        spec = self._spec(field, 'zset')
+        return spec.decode_pairs(await self._db.zpopmin(
+            self._field_key(spec), count))
+
+    async def zremrangebyrank(self, field, start, stop):
+        return await self._db.zremrangebyrank(
+            self._field_key(self._spec(field, 'zset')), start, stop)
+
+    async def zadd(self, field, *args, nx=False, xx=False, ch=False):
+        """ Add members to a sorted set field, see Entity.zadd """
+        spec = self._spec(field, 'zset')
+        mapping = self.entity._zadd_mapping(args)
+        if not mapping:
+            return 0
+        return await self._db.zadd(self._field_key(spec), mapping, nx=nx,
+                                   xx=xx, ch=ch)
+
+    async def zrem(self, field, *args):
+        return await self._db.zrem(
+            self._field_key(self._spec(field, 'zset')), *args)
@@ -0,0 +1,338 @@
+""" Benchmarks for apollo.
+
+The microbenchmarks make calls against an in-process stand-in for a redis
+client that returns canned replies immediately, so the timings measure only
+the python work apollo does per call (field validation, key building and
+decoding), not network or server time.
+
+The suite runs whole operations (creates, lookup and relation writes, deletes
+with a large fan-out, large set reads and sorted set operations) against a
+local redis-server, or against fakeredis in process, and reports for each the
+throughput, the p50 and p99 latency, and the redis commands and round trips
+issued per operation. With --json the results are also written as JSON, so
+that runs on different commits can be compared. It flushes the selected
+database of the redis-server.
+
+The memory benchmark instead stores count small entities on a local
+redis-server, once with one hash per entity and once bucketed, and reports the
+server's used_memory for each layout. It flushes the selected database.
+
+Usage: python bench_apollo.py [iterations]
+       python bench_apollo.py suite [--ops N] [--backend redis|fake] [--db N]
+                                    [--scripted] [--json path]
+       python bench_apollo.py memory [count] [db]
+
+"""
+import argparse
+import json
+import sys
+import time
+import timeit
+
+import apollo
+
+
+class _NullRedis():
+    """ Answers every command immediately with a fixed reply """
+
+    def sismember(self, key, value):
+        return True
+
+    def hget(self, key, field):
+        return '25'
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        return 1
+
+    def hincrby(self, key, field, count=1):
+        return 26
+
+    def smembers(self, key):
+        return {'1', '2', '3'}
+
+
+class Person(apollo.Entity):
+    prefix = 'person'
+    fields = {'age': int,
+              'ssn': str,
+              'favorite_numbers': {int}}
+
+
+class Account(apollo.Entity):
+    prefix = 'account'
+    fields = {'age': int,
+              'ssn': str,
+              'zip': str}
+
+
+class CompactAccount(apollo.Entity):
+    prefix = 'compact_account'
+    buckets = 1
+    fields = {'age': int,
+              'ssn': str,
+              'zip': str}
+
+Account.add_lookup('ssn')
+CompactAccount.add_lookup('ssn')
+
+
+def run_memory(db, count, per_bucket=32):
+    """ Bytes of server memory used by count entities, and by their ssn
+        lookup, in each layout. Each bucket holds about per_bucket entities,
+        which keeps it well under the default listpack limit of 128 entries.
+
+    """
+    import redis
+    db = redis.Redis(db=db, decode_responses=True)
+    CompactAccount.buckets = max(1, count // per_bucket)
+    results = {}
+    for entity in (Account, CompactAccount):
+        db.flushdb()
+        before = db.info('memory')['used_memory']
+        ids = [str(i) for i in range(count)]
+        entity.create_many(ids, db, fields=dict(
+            (id, {'age': 30, 'ssn': 'ssn-'+id, 'zip': '94110'})
+            for id in ids))
+        results[entity.__name__] = db.info('memory')['used_memory'] - before
+    db.flushdb()
+    return results
+
+
+def run(iterations):
+    db = _NullRedis()
+    joe = Person.instance('joe', db)
+    cases = [('instance', lambda: Person.instance('joe', db)),
+             ('hget', lambda: joe.hget('age')),
+             ('hset', lambda: joe.hset('age', 25)),
+             ('hincrby', lambda: joe.hincrby('age')),
+             ('smembers', lambda: joe.smembers('favorite_numbers')),
+             ('sismember', lambda: joe.sismember('favorite_numbers', 1))]
+    results = {}
+    for name, call in cases:
+        elapsed = min(timeit.repeat(call, number=iterations, repeat=5))
+        results[name] = elapsed / iterations * 1e6
+    return results
+
+
+class _CountingRedis():
+    """ Forwards every call to a client, counting the commands and round trips
+        made. A pipeline counts one round trip and each of its commands.
+
+    """
+    def __init__(self, db):
+        self._db = db
+        self.commands = 0
+        self.round_trips = 0
+
+    def pipeline(self, transaction=True):
+        return _CountingPipeline(self, self._db.pipeline(
+            transaction=transaction))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attr = getattr(self._db, name)
+
+        def _command(*args, **kwargs):
+            self.commands += 1
+            self.round_trips += 1
+            return attr(*args, **kwargs)
+        return _command
+
+
+class _CountingPipeline():
+    def __init__(self, counter, pipe):
+        self._counter = counter
+        self._pipe = pipe
+        self._queued = 0
+
+    def execute(self):
+        if self._queued:
+            self._counter.round_trips += 1
+        self._queued = 0
+        return self._pipe.execute()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attr = getattr(self._pipe, name)
+
+        def _queue(*args, **kwargs):
+            self._queued += 1
+            self._counter.commands += 1
+            attr(*args, **kwargs)
+            return self
+        return _queue
+
+
+class Member(apollo.Entity):
+    prefix = 'member'
+    fields = {'ssn': str,
+              'food': str,
+              'tasks': apollo.zset(str)}
+
+
+class Pet(apollo.Entity):
+    prefix = 'pet'
+    fields = {}
+
+Member.add_lookup('ssn')
+Member.add_lookup('food', injective=False)
+apollo.relate(Member, 'pets', {Pet}, 'owner')
+apollo.relate({Member}, 'friends', {Member}, 'friends')
+
+
+def _suite_cases(db, ops, fanout):
+    """ (name, setup, op, count) for every case of the suite. setup prepares
+        the state op needs and is not timed, op(i) is timed for i in
+        range(count).
+
+    """
+    state = {}
+
+    def members(count, prefix='m'):
+        return Member.create_many([prefix+str(i) for i in range(count)], db)
+
+    def pets(count):
+        return Pet.create_many(['p'+str(i) for i in range(count)], db)
+
+    def setup_one():
+        state['joe'] = members(1, 'joe')[0]
+
+    def setup_pets():
+        state['joe'] = members(1, 'joe')[0]
+        state['pets'] = pets(ops)
+
+    def setup_linked_pets():
+        setup_pets()
+        state['joe'].sadd('pets', *state['pets'])
+
+    def setup_friends():
+        state['joe'] = members(1, 'joe')[0]
+        state['friends'] = members(ops)
+
+    def setup_linked_friends():
+        setup_friends()
+        state['joe'].sadd('friends', *state['friends'])
+
+    def setup_fanout():
+        count = max(1, ops // fanout)
+        state['victims'] = members(count, 'v')
+        state['pets'] = pets(count*fanout)
+        for i, victim in enumerate(state['victims']):
+            victim.sadd('pets', *state['pets'][i*fanout:(i+1)*fanout])
+            victim.hset('ssn', 'v'+str(i))
+
+    def setup_large_set():
+        setup_linked_friends()
+
+    def setup_tasks():
+        state['joe'] = members(1, 'joe')[0]
+        state['joe'].zadd('tasks', dict(('t'+str(i), i)
+                                         for i in range(ops)))
+
+    return [
+        ('create', None, lambda i: Member.create('c'+str(i), db), ops),
+        ('hset_injective_lookup', setup_one,
+         lambda i: state['joe'].hset('ssn', 's'+str(i)), ops),
+        ('hset_lookup', setup_one,
+         lambda i: state['joe'].hset('food', 'f'+str(i % 50)), ops),
+        ('sadd_1_to_n', setup_pets,
+         lambda i: state['joe'].sadd('pets', state['pets'][i]), ops),
+        ('srem_1_to_n', setup_linked_pets,
+         lambda i: state['joe'].srem('pets', state['pets'][i]), ops),
+        ('sadd_n_to_n', setup_friends,
+         lambda i: state['joe'].sadd('friends', state['friends'][i]), ops),
+        ('srem_n_to_n', setup_linked_friends,
+         lambda i: state['joe'].srem('friends', state['friends'][i]), ops),
+        ('delete_fanout_'+str(fanout), setup_fanout,
+         lambda i: state['victims'][i].delete(), max(1, ops // fanout)),
+        ('smembers_'+str(ops), setup_large_set,
+         lambda i: state['joe'].smembers('friends'), max(1, ops // 100)),
+        ('zadd', setup_one,
+         lambda i: state['joe'].zadd('tasks', {'t'+str(i): i}), ops),
+        ('zrange', setup_tasks,
+         lambda i: state['joe'].zrange('tasks', 0, 9), ops),
+    ]
+
+
+def _percentile(timings, fraction):
+    return timings[min(len(timings)-1, int(len(timings)*fraction))]
+
+
+def run_suite(db, ops=1000, fanout=100):
+    """ Run every case of the suite against the empty database db, returning
+        a dict of results keyed by case name.
+
+    """
+    results = {}
+    counter = _CountingRedis(db)
+    for name, setup, op, count in _suite_cases(counter, ops, fanout):
+        db.flushdb()
+        if setup is not None:
+            setup()
+        counter.commands = counter.round_trips = 0
+        timings = []
+        start = time.perf_counter()
+        for i in range(count):
+            began = time.perf_counter()
+            op(i)
+            timings.append(time.perf_counter() - began)
+        elapsed = time.perf_counter() - start
+        timings.sort()
+        results[name] = {
+            'ops': count,
+            'ops_per_sec': count / elapsed,
+            'p50_usec': _percentile(timings, 0.5) * 1e6,
+            'p99_usec': _percentile(timings, 0.99) * 1e6,
+            'commands_per_op': counter.commands / count,
+            'round_trips_per_op': counter.round_trips / count}
+    db.flushdb()
+    return results
+
+
+def _suite_main(argv):
+    parser = argparse.ArgumentParser(prog='bench_apollo.py suite')
+    parser.add_argument('--ops', type=int, default=1000)
+    parser.add_argument('--fanout', type=int, default=100)
+    parser.add_argument('--backend', choices=('redis', 'fake'),
+                        default='redis')
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--scripted', action='store_true')
+    parser.add_argument('--json')
+    args = parser.parse_args(argv)
+    if args.backend == 'fake':
+        import fakeredis
+        db = fakeredis.FakeRedis(decode_responses=True)
+    else:
+        import redis
+        db = redis.Redis(db=args.db, decode_responses=True)
+    apollo.Entity.scripted = args.scripted
+    results = run_suite(db, args.ops, args.fanout)
+    print('{0:<24} {1:>10} {2:>10} {3:>10} {4:>9} {5:>7}'.format(
+        'case', 'ops/sec', 'p50 usec', 'p99 usec', 'cmds/op', 'rtt/op'))
+    for name, result in results.items():
+        print('{0:<24} {1:10.0f} {2:10.1f} {3:10.1f} {4:9.2f} {5:7.2f}'.format(
+            name, result['ops_per_sec'], result['p50_usec'],
+            result['p99_usec'], result['commands_per_op'],
+            result['round_trips_per_op']))
+    if args.json:
+        with open(args.json, 'w') as stream:
+            json.dump({'backend': args.backend, 'scripted': args.scripted,
+                       'ops': args.ops, 'fanout': args.fanout,
+                       'time': time.time(), 'results': results},
+                      stream, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'suite':
+        _suite_main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'memory':
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        db = int(sys.argv[3]) if len(sys.argv) > 3 else 15
+        for name, used in run_memory(db, count).items():
+            print('{0:<16} {1:8.1f} bytes/entity'.format(name, used / count))
+    else:
+        iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+        for name, usec in run(iterations).items():
+            print('{0:<12} {1:8.3f} usec/call'.format(name, usec))
@@ -1,7 +1,12 @@
 import unittest
 import apollo
 import redis
+import redis.asyncio
+import asyncio
+import io
+import json
 import sys
+import time
 
 redis_client = redis.Redis(decode_responses=True)
 redis_client.ping()
@@ -14,7 +19,9 @@ class Person(apollo.Entity):
               'favorite_food': str,
               'emails': {str},
               'favorite_songs': {str},
-              'tasks': apollo.zset(str)
+              'tasks': apollo.zset(str),
+              'events': [str],
+              'readings': [float]
               }
 
 
@@ -22,16 +29,51 @@ class Cat(apollo.Entity):
     prefix = 'cat'
     fields = {'age': int}
 
+
+class Badge(apollo.Entity):
+    prefix = 'badge'
+    buckets = 8
+    fields = {'level': int,
+              'serial': str,
+              'color': str,
+              'tags': {str}}
+
+Badge.add_lookup('serial')
+Badge.add_lookup('color', injective=False)
+Badge.add_lookup('tags')
+Badge.add_range_index('level')
+
+class Store(apollo.Entity):
+    prefix = 'store'
+    hash_tags = True
+    fields = {'rating': int,
+              'city': str,
+              'items': {str}}
+
+Store.add_lookup('city', injective=False)
+apollo.relate({Store}, 'partners', {Store}, 'partners')
+
+
+class Mall(apollo.Entity):
+    prefix = 'mall'
+    fields = {'name': str}
+
+apollo.relate(Mall, 'stores', {Store}, 'mall')
+
 Person.add_lookup('ssn')
 Person.add_lookup('favorite_food', injective=False)
 Person.add_lookup('emails')
 Person.add_lookup('favorite_songs', injective=False)
+Person.add_range_index('age')
 
 apollo.relate(Person, 'cats', {Cat}, 'owner')
 apollo.relate({Person}, 'cats_to_feed', {Cat}, 'caretakers')
 apollo.relate({Person}, 'friends', {Person}, 'friends')
 apollo.relate(Person, 'best_friend', Person, 'best_friend')
 apollo.relate(Person, 'single_cat', Cat, 'single_owner')
+# one way relations, without an inverse field on Cat
+apollo.relate(Person, 'favorite_cats', {Cat})
+apollo.relate(Person, 'favorite_cat', Cat)
 
 
 class TestApollo(unittest.TestCase):
@@ -418,6 +460,865 @@ class TestApollo(unittest.TestCase):
         sphinx.delete()
         self.assertListEqual(self.db.keys('*'), [])
 
+    def test_delete_large_fanout(self):
+        joe = Person.create('joe', self.db)
+        bob = Person.create('bob', self.db)
+        cats = [Cat.create('cat'+str(i), self.db) for i in range(50)]
+        joe.sadd('cats', *cats)
+        joe.sadd('friends', bob)
+        joe.sadd('emails', 'joe@gmail.com', 'joe@hotmail.com')
+        joe.sadd('favorite_songs', 'prelude', 'nocturne')
+        joe.hset('ssn', '123-45-6789')
+        joe.hset('best_friend', bob)
+
+        joe.delete(chunk_size=7)
+        self.assertFalse(Person.exists('joe', self.db))
+        for cat in cats:
+            self.assertEqual(cat.hget('owner'), None)
+        self.assertSetEqual(bob.smembers('friends'), set())
+        self.assertEqual(bob.hget('best_friend'), None)
+        self.assertEqual(Person.lookup('ssn', '123-45-6789', self.db), None)
+        self.assertEqual(Person.lookup('emails', 'joe@gmail.com', self.db),
+                         None)
+        self.assertSetEqual(Person.lookup('favorite_songs', 'nocturne',
+                                          self.db), set())
+
+        bob.delete()
+        for cat in cats:
+            cat.delete()
+
+    def test_create_many(self):
+        sphinx = Cat.create('sphinx', self.db)
+        joe, bob = Person.create_many(
+            ['joe', 'bob'], self.db,
+            fields={'joe': {'age': 25, 'ssn': '123-45-6789',
+                            'favorite_food': 'pizza', 'single_cat': sphinx},
+                    'bob': {'favorite_food': 'pizza'}},
+            batch_size=1)
+        self.assertEqual(joe.hget('age'), 25)
+        self.assertEqual(Person.lookup('ssn', '123-45-6789', self.db), 'joe')
+        self.assertSetEqual(Person.lookup('favorite_food', 'pizza', self.db),
+                            {'joe', 'bob'})
+        self.assertEqual(sphinx.hget('single_owner'), 'joe')
+
+        # the second person takes over sphinx from joe
+        eve, = Person.create_many(['eve'], self.db,
+                                  fields={'eve': {'single_cat': 'sphinx'}})
+        self.assertEqual(sphinx.hget('single_owner'), 'eve')
+        self.assertEqual(joe.hget('single_cat'), None)
+
+        self.assertRaises(KeyError, Person.create_many, ['amy', 'joe'],
+                          self.db)
+        self.assertFalse(Person.exists('amy', self.db))
+        self.assertRaises(TypeError, Person.create_many, ['amy'], self.db,
+                          fields={'amy': {'bad_field': 1}})
+
+        # two claimants of one side of a 1 to 1 relation in one batch
+        self.assertRaises(ValueError, Person.create_many, ['amy', 'ann'],
+                          self.db, fields={'amy': {'single_cat': 'sphinx'},
+                                           'ann': {'single_cat': sphinx}})
+        self.assertRaises(ValueError, Person.create_many, ['amy', 'ann'],
+                          self.db, fields={'amy': {'best_friend': 'ann'},
+                                           'ann': {'best_friend': 'eve'}})
+        self.assertFalse(Person.exists('amy', self.db))
+        self.assertEqual(sphinx.hget('single_owner'), 'eve')
+        amy, ann = Person.create_many(['amy', 'ann'], self.db, fields={
+            'amy': {'best_friend': 'ann'}, 'ann': {'best_friend': 'amy'}})
+        self.assertEqual(ann.hget('best_friend'), 'amy')
+
+        # an id created by another client before the MULTI/EXEC aborts the
+        # write, and the retry then finds it
+        pipeline = self.db.pipeline
+
+        def racing_pipeline(transaction=True):
+            pipe = pipeline(transaction=transaction)
+            execute = pipe.execute
+
+            def racing_execute():
+                results = execute()
+                if not transaction and not Person.exists('kim', self.db):
+                    self.db.sadd('persons', 'kim')
+                return results
+            pipe.execute = racing_execute
+            return pipe
+        self.db.pipeline = racing_pipeline
+        try:
+            self.assertRaises(KeyError, Person.create_many, ['zed', 'kim'],
+                              self.db, fields={'zed': {'ssn': '999'}})
+        finally:
+            del self.db.pipeline
+        self.assertFalse(Person.exists('zed', self.db))
+        self.assertEqual(Person.lookup('ssn', '999', self.db), None)
+
+        # a partner taken by another client after it was read aborts the
+        # write, and the retry releases the new partner instead
+        raced = []
+
+        def racing_pipeline(transaction=True):
+            pipe = pipeline(transaction=transaction)
+            execute = pipe.execute
+
+            def racing_execute():
+                results = execute()
+                if not transaction and not raced:
+                    raced.append(True)
+                    joe.hset('single_cat', sphinx)
+                return results
+            pipe.execute = racing_execute
+            return pipe
+        self.db.pipeline = racing_pipeline
+        try:
+            Person.create_many(['liz'], self.db,
+                               fields={'liz': {'single_cat': 'sphinx'}})
+        finally:
+            del self.db.pipeline
+        self.assertEqual(sphinx.hget('single_owner'), 'liz')
+        self.assertEqual(joe.hget('single_cat'), None)
+        self.assertEqual(eve.hget('single_cat'), None)
+
+        Person.delete_many(['joe', 'bob', 'eve', 'amy', 'ann', 'kim', 'liz'],
+                           self.db, batch_size=2)
+        self.assertSetEqual(Person.members(self.db), set())
+        self.assertEqual(sphinx.hget('single_owner'), None)
+        self.assertSetEqual(Person.lookup('favorite_food', 'pizza', self.db),
+                            set())
+        self.assertRaises(KeyError, Person.delete_many, ['sphinx'], self.db)
+        Cat.delete_many(['sphinx'], self.db)
+
+    def test_load(self):
+        joe = Person.create('joe', self.db)
+        sphinx = Cat.create('sphinx', self.db)
+        joe.hset('age', 25)
+        joe.hset('ssn', '123-45-6789')
+        joe.hset('single_cat', sphinx)
+        joe.sadd('emails', 'joe@gmail.com')
+        joe.sadd('cats', sphinx)
+
+        values = joe.load()
+        self.assertEqual(values['age'], 25)
+        self.assertEqual(values['ssn'], '123-45-6789')
+        self.assertEqual(values['single_cat'], 'sphinx')
+        self.assertEqual(values['favorite_food'], None)
+        self.assertNotIn('emails', values)
+
+        values = joe.load(collections=True)
+        self.assertSetEqual(values['emails'], {'joe@gmail.com'})
+        self.assertSetEqual(values['cats'], {'sphinx'})
+        self.assertListEqual(values['tasks'], [])
+        self.assertListEqual(values['events'], [])
+
+        self.assertDictEqual(joe.load(['age', 'emails']),
+                             {'age': 25, 'emails': {'joe@gmail.com'}})
+        self.assertRaises(TypeError, joe.load, ['bad_field'])
+
+        joe.delete()
+        sphinx.delete()
+
+    def test_traverse(self):
+        ids = ['p'+str(i) for i in range(6)]
+        p0, p1, p2, p3, p4, p5 = Person.create_many(ids, self.db)
+        p0.sadd('friends', p1, p2)
+        p1.sadd('friends', p3)
+        p2.sadd('friends', p3, p4)
+        p4.sadd('friends', p5)
+        cat = Cat.create('tom', self.db)
+        p3.sadd('cats', cat)
+
+        levels = Person.traverse(['p0'], 'friends', self.db, depth=3)
+        self.assertListEqual(levels, [{'p1', 'p2'}, {'p3', 'p4'}, {'p5'}])
+        # friendship is symmetric, so p0 is never revisited
+        levels = Person.traverse([p1], 'friends', self.db, depth=2)
+        self.assertListEqual(levels, [{'p0', 'p3'}, {'p2'}])
+        levels = Person.traverse(['p0'], ['friends', 'friends', 'cats'],
+                                 self.db)
+        self.assertSetEqual(levels[2], {'tom'})
+        levels = Cat.traverse(['tom'], ['owner', 'friends'], self.db)
+        self.assertListEqual(levels, [{'p3'}, {'p1', 'p2'}])
+        levels = Person.traverse(['p0', 'p2'], 'friends', self.db,
+                                 max_fanout=1)
+        self.assertLessEqual(len(levels[0]), 2)
+        levels = Person.traverse(['p5'], 'friends', self.db, depth=2,
+                                 hydrate=True)
+        self.assertTrue(all(isinstance(p, Person) for p in levels[1]))
+        self.assertListEqual([p.id for p in levels[1]], ['p2'])
+        self.assertRaises(TypeError, Person.traverse, ['p0'], 'age', self.db)
+        # one way relations are followed too
+        p5.sadd('favorite_cats', cat)
+        p4.hset('favorite_cat', cat)
+        levels = Person.traverse(['p2'], ['friends', 'favorite_cats'],
+                                 self.db)
+        self.assertListEqual(levels, [{'p0', 'p3', 'p4'}, set()])
+        levels = Person.traverse(['p4'], ['friends', 'favorite_cats'],
+                                 self.db)
+        self.assertListEqual(levels, [{'p2', 'p5'}, {'tom'}])
+        levels = Person.traverse(['p4', 'p5'], 'favorite_cat', self.db,
+                                 hydrate=True)
+        self.assertIsInstance(levels[0][0], Cat)
+
+        cat.delete()
+        Person.delete_many(ids, self.db)
+
+    def test_batched_set_writes(self):
+        joe, bob = Person.create_many(['joe', 'bob'], self.db)
+        cats = Cat.create_many(['c'+str(i) for i in range(50)], self.db)
+        joe.sadd('cats', *cats)
+        bob.sadd('cats', *cats[:10])
+        self.assertEqual(joe.scard('cats'), 40)
+        self.assertEqual(cats[0].hget('owner'), 'bob')
+        self.assertRaises(KeyError, joe.sadd, 'cats', cats[0], 'nobody')
+        self.assertEqual(cats[0].hget('owner'), 'bob')
+
+        # an invalid value leaves the whole set untouched
+        self.assertRaises(ValueError, joe.srem, 'cats', *(cats[10:] + ['x']))
+        self.assertEqual(joe.scard('cats'), 40)
+        joe.srem('cats', *cats[10:])
+        self.assertEqual(joe.scard('cats'), 0)
+        self.assertEqual(cats[10].hget('owner'), None)
+
+        joe.sadd('emails', 'joe@a.com', 'jo@a.com')
+        bob.sadd('emails', 'jo@a.com')
+        self.assertSetEqual(joe.smembers('emails'), {'joe@a.com'})
+        self.assertEqual(Person.lookup('emails', 'jo@a.com', self.db), 'bob')
+
+        for cat in cats:
+            cat.delete()
+        joe.delete()
+        bob.delete()
+
+    def test_bucketed(self):
+        ids = ['b'+str(i) for i in range(20)]
+        badges = Badge.create_many(ids, self.db, fields=dict(
+            (id, {'level': i, 'serial': 's'+str(i)})
+            for i, id in enumerate(ids)))
+        # no per-entity hashes, only the shared buckets
+        self.assertListEqual(self.db.keys('badge:*'), [])
+        self.assertLessEqual(len(self.db.keys('badge#*')), 8)
+        self.assertLessEqual(len(self.db.keys('serial#*')), 8)
+
+        b0, b1 = badges[:2]
+        self.assertEqual(b1.hget('level'), 1)
+        self.assertEqual(Badge.lookup('serial', 's1', self.db), 'b1')
+        b1.hset('serial', 'new')
+        self.assertEqual(Badge.lookup('serial', 'new', self.db), 'b1')
+        self.assertEqual(Badge.lookup('serial', 's1', self.db), None)
+        self.assertEqual(Badge.lookup_count('serial', 'new', self.db), 1)
+        self.assertEqual(b1.hincrby('level', 100), 101)
+        self.assertListEqual(Badge.top_k('level', 1, self.db), ['b1'])
+        b1.hset('color', 'red')
+        b0.hset('color', 'red')
+        self.assertSetEqual(Badge.lookup('color', 'red', self.db),
+                            {'b0', 'b1'})
+        b1.sadd('tags', 'x', 'y')
+        self.assertEqual(Badge.lookup('tags', 'x', self.db), 'b1')
+        self.assertDictEqual(b1.load(), {'level': 101, 'serial': 'new',
+                                         'color': 'red'})
+        self.assertListEqual(Badge.mget(['b0', 'b1'], ['level', 'serial'],
+                                        self.db),
+                             [{'level': 0, 'serial': 's0'},
+                              {'level': 101, 'serial': 'new'}])
+        b0.hdel('serial')
+        self.assertEqual(b0.hget('serial'), None)
+        self.assertEqual(Badge.lookup('serial', 's0', self.db), None)
+
+        self.assertRaises(TypeError, apollo.AsyncEntity.of, Badge)
+
+        b1.delete()
+        self.assertEqual(Badge.lookup('tags', 'x', self.db), None)
+        self.assertEqual(Badge.lookup('serial', 'new', self.db), None)
+        Badge.delete_many(ids[:1] + ids[2:], self.db)
+
+    def test_bucketed_relations(self):
+        class Token(apollo.Entity):
+            prefix = 'token'
+            buckets = 4
+            fields = {}
+
+        class Wallet(apollo.Entity):
+            prefix = 'wallet'
+            fields = {}
+
+        apollo.relate({Token}, 'wallets', {Wallet}, 'tokens')
+        self.assertRaises(TypeError, apollo.relate, Token, 'wallet', Wallet,
+                          'token')
+        self.assertRaises(TypeError, apollo.relate, Wallet, 'token', {Token},
+                          'wallet')
+        # neither class is left half related
+        self.assertNotIn('wallet', Token.fields)
+        self.assertNotIn('token', Wallet.fields)
+        self.assertNotIn('token', Wallet.relations)
+        apollo.relate({Token}, 'holders', {Wallet}, 'held')
+        self.assertIn('holders', Token._specs)
+
+    def test_scripted_relation_to_hash_tags(self):
+        # the scripts cannot build Store's hash tagged keys, so Mall falls
+        # back to client side writes even when scripted
+        Mall.scripted = True
+        try:
+            mall, other = Mall.create_many(['m1', 'm2'], self.db)
+            s1, s2 = Store.create_many(['s1', 's2'], self.db)
+            mall.sadd('stores', s1, s2)
+            self.assertEqual(s1.hget('mall'), 'm1')
+            self.assertEqual(self.db.hget('store:{s1}', 'mall'), 'm1')
+            other.sadd('stores', s2)
+            self.assertSetEqual(mall.smembers('stores'), {'s1'})
+            mall.srem('stores', s1)
+            self.assertEqual(s1.hget('mall'), None)
+            self.assertListEqual(self.db.keys('store:s*'), [])
+            self.assertRaises(TypeError, apollo.AsyncEntity.of, Mall)
+        finally:
+            Mall.scripted = False
+        Mall.delete_many(['m1', 'm2'], self.db)
+        Store.delete_many(['s1', 's2'], self.db)
+
+    def test_sharded(self):
+        nodes = dict((name, redis.Redis(db=i+1, decode_responses=True))
+                     for i, name in enumerate('abcd'))
+        for node in nodes.values():
+            node.flushdb()
+        db = apollo.ShardedRedis(dict((name, nodes[name]) for name in 'abc'))
+        ids = ['s'+str(i) for i in range(30)]
+        stores = Store.create_many(ids, db, fields=dict(
+            (id, {'rating': i, 'city': 'sf' if i % 2 else 'la'})
+            for i, id in enumerate(ids)))
+        for store in stores[1:]:
+            store.sadd('items', 'apple')
+            stores[0].sadd('partners', store)
+        self.assertEqual(stores[5].hget('rating'), 5)
+        self.assertSetEqual(stores[5].smembers('partners'), {'s0'})
+        self.assertEqual(len(Store.lookup('city', 'sf', db)), 15)
+        # the keys of each store live on the node of its id
+        for name, node in nodes.items():
+            for key in node.keys('store:*'):
+                self.assertEqual(db.node_name(key), name)
+                self.assertIn('{', key)
+        self.assertGreater(len([node for node in nodes.values()
+                                if node.keys('store:*')]), 1)
+        self.assertRaises(ValueError, db.sinter, ['store:{s1}:items',
+                                                  'store:{s2}:items',
+                                                  'store:{s3}:items'])
+        self.assertRaises(ValueError, db.dbsize)
+        self.assertRaises(ValueError, db.watch, 'stores')
+        self.assertRaises(ValueError, db.pipeline().multi)
+        self.assertRaises(ValueError, apollo.Session, db, watch=True)
+        self.assertSetEqual(set(db.scan_iter(match='store:*')),
+                            set(key for node in nodes.values()
+                                for key in node.keys('store:*')))
+        self.assertEqual(Store.check(db)['problems'], 0)
+
+        grown = apollo.ShardedRedis(nodes)
+        leaving = [key for name in 'abc' for key in nodes[name].keys('*')
+                   if grown.node_name(key) != name]
+        # a write to a key on its old node while it is being copied is
+        # copied again rather than lost
+        written = next(key for key in leaving if key.count(':') == 1)
+        source = nodes[db.node_name(written)]
+        pipeline = source.pipeline
+
+        def racing_pipeline(transaction=True):
+            pipe = pipeline(transaction=transaction)
+            execute = pipe.execute
+
+            def racing_execute():
+                results = execute()
+                if not transaction and not source.hexists(written, 'city'):
+                    source.hset(written, 'city', 'ny')
+                return results
+            pipe.execute = racing_execute
+            return pipe
+        source.pipeline = racing_pipeline
+        source.hdel(written, 'city')
+        try:
+            moved = apollo.reshard(db, grown, batch_size=7)
+        finally:
+            del source.pipeline
+        self.assertEqual(moved, len(leaving))
+        self.assertEqual(grown.hget(written, 'city'), 'ny')
+        self.assertEqual(source.exists(written), 0)
+        grown.hset(written, 'city', 'sf' if int(written[8:-1]) % 2 else 'la')
+        self.assertGreater(len(nodes['d'].keys('*')), 0)
+        for name, node in nodes.items():
+            for key in node.keys('*'):
+                self.assertEqual(grown.node_name(key), name)
+        self.assertEqual(stores[5].instance('s5', grown).hget('rating'), 5)
+        self.assertEqual(len(Store.lookup('city', 'sf', grown)), 15)
+        self.assertSetEqual(Store('s0', grown).smembers('partners'),
+                            set(ids[1:]))
+
+        Store.delete_many(ids, grown)
+        for node in nodes.values():
+            self.assertListEqual(node.keys('*'), [])
+
+    def test_session(self):
+        joe, bob = Person.create_many(['joe', 'bob'], self.db)
+        joe.hset('age', 30)
+        cat = Cat.create('tom', self.db)
+        with apollo.Session(self.db) as session:
+            s_joe = session.get(Person, 'joe')
+            self.assertIs(session.get(Person, 'joe'), s_joe)
+            s_joe.hset('ssn', '123')
+            self.assertEqual(s_joe.hincrby('age', 2), 32)
+            s_joe.sadd('friends', session.get(Person, 'bob'))
+            s_joe.sadd('cats', cat.id)
+            s_eve = Person.create('eve', session)
+            s_eve.hset('favorite_food', 'pizza')
+            # reads see the buffered writes, the server does not yet
+            self.assertEqual(s_joe.hget('age'), 32)
+            self.assertEqual(Person.lookup('ssn', '123', session), 'joe')
+            self.assertSetEqual(session.get(Person, 'bob').smembers(
+                'friends'), {'joe'})
+            self.assertEqual(Cat('tom', session).hget('owner'), 'joe')
+            self.assertDictEqual(s_joe.load(['age', 'ssn']),
+                                 {'age': 32, 'ssn': '123'})
+            self.assertEqual(joe.hget('age'), 30)
+            self.assertEqual(Person.lookup('ssn', '123', self.db), None)
+            self.assertFalse(Person.exists('eve', self.db))
+        self.assertEqual(joe.hget('age'), 32)
+        self.assertEqual(Person.lookup('ssn', '123', self.db), 'joe')
+        self.assertSetEqual(bob.smembers('friends'), {'joe'})
+        self.assertEqual(cat.hget('owner'), 'joe')
+        self.assertListEqual(Person.range_lookup('age', 32, 32, self.db),
+                             ['joe'])
+        self.assertSetEqual(Person.lookup('favorite_food', 'pizza', self.db),
+                            {'eve'})
+
+        # deletes are buffered too, including their cleanup
+        session = apollo.Session(self.db)
+        session.get(Person, 'eve').delete()
+        self.assertFalse(Person.exists('eve', session))
+        self.assertSetEqual(Person.lookup('favorite_food', 'pizza', session),
+                            set())
+        session.discard()
+        self.assertTrue(Person.exists('eve', self.db))
+
+        session = apollo.Session(self.db, watch=True)
+        session.get(Person, 'joe').hincrby('age')
+        joe.hset('age', 40)
+        self.assertRaises(redis.exceptions.WatchError, session.flush)
+        self.assertEqual(joe.hget('age'), 40)
+
+        Person.delete_many(['joe', 'bob', 'eve'], self.db)
+        cat.delete()
+
+    def test_instrumentation(self):
+        original = Person.hset
+        records = []
+        stats = apollo.Instrumentation(slow_threshold=0.0, slow_log_size=2,
+                                       exporters=[records.append])
+        apollo.instrument(stats)
+        try:
+            with self.assertLogs('apollo', 'WARNING'):
+                joe = Person.create('joe', self.db)
+                sphinx = Cat.create('sphinx', self.db)
+                sphinx.hset('owner', joe)
+                joe.hget('age')
+                self.assertRaises(TypeError, joe.hget, 'nope')
+        finally:
+            apollo.instrument(None)
+        self.assertIs(Person.hset, original)
+
+        hset = stats.stats()['Cat']['hset']
+        self.assertEqual(hset['calls'], 1)
+        # the relation writes and nested calls count towards the outer hset
+        self.assertGreater(hset['commands'], 0 if Cat.scripted else 1)
+        self.assertGreaterEqual(hset['commands'], hset['round_trips'])
+        self.assertGreater(hset['bytes_sent'], 0)
+        self.assertEqual(sum(hset['histogram']), 1)
+        self.assertEqual(stats.stats()['Person']['hget']['errors'], 1)
+        self.assertListEqual([(r.entity, r.method) for r in records],
+                             [('Person', 'create'), ('Cat', 'create'),
+                              ('Cat', 'hset'), ('Person', 'hget'),
+                              ('Person', 'hget')])
+        self.assertEqual(len(stats.slow_ops), 2)
+
+        # nothing is recorded once disabled
+        joe.hget('age')
+        self.assertEqual(len(records), 5)
+        sphinx.delete()
+        joe.delete()
+
+    def test_instrumentation_threads_and_static_methods(self):
+        original = apollo.Entity.__dict__['verify']
+        people = Person.create_many(['p%d' % i for i in range(8)], self.db)
+        stats = apollo.Instrumentation()
+        apollo.instrument(stats)
+        try:
+            apollo.Entity.verify(people)
+            Person.check(self.db, workers=2, batch_size=2,
+                         scan_lookups=False)
+        finally:
+            apollo.instrument(None)
+        self.assertIs(apollo.Entity.__dict__['verify'], original)
+        self.assertEqual(stats.stats()['Entity']['verify']['calls'], 1)
+        # the pipelines of the worker threads count towards the check, on
+        # top of the single command SSCANs done on the calling thread
+        check = stats.stats()['Person']['check']
+        self.assertEqual(check['calls'], 1)
+        self.assertGreater(check['commands'], check['round_trips'])
+        Person.delete_many([person.id for person in people], self.db)
+
+    def test_export_import(self):
+        joe, bob = Person.create_many(['joe', 'bob'], self.db, fields={
+            'joe': {'age': 30, 'ssn': '123', 'favorite_food': 'pizza'}})
+        joe.sadd('emails', 'joe@a.com', 'jo@a.com')
+        joe.sadd('friends', bob)
+        joe.zadd('tasks', {'write': 1, 'read': 2})
+        joe.rpush('events', 'born', 'hired')
+        tom, kit = Cat.create_many(['tom', 'kit'], self.db)
+        joe.sadd('cats', tom, kit)
+        kit.hset('age', 3)
+
+        people, cats = io.StringIO(), io.StringIO()
+        self.assertEqual(Person.export(self.db, people, batch_size=1)[
+            'entities'], 2)
+        self.assertEqual(Cat.export(self.db, cats)['entities'], 2)
+        rows = [json.loads(line) for line in people.getvalue().splitlines()]
+        self.assertDictEqual(rows[0], {'prefix': 'person'})
+        self.db.flushdb()
+
+        people.seek(0)
+        cats.seek(0)
+        self.assertRaises(ValueError, Cat.import_, self.db, people)
+        people.seek(0)
+        self.assertEqual(Person.import_(self.db, people, batch_size=1)[
+            'entities'], 2)
+        self.assertEqual(Cat.import_(self.db, cats)['entities'], 2)
+
+        self.assertSetEqual(Person.members(self.db), {'joe', 'bob'})
+        self.assertEqual(joe.hget('age'), 30)
+        self.assertEqual(Person.lookup('ssn', '123', self.db), 'joe')
+        self.assertEqual(Person.lookup('emails', 'jo@a.com', self.db), 'joe')
+        self.assertSetEqual(Person.lookup('favorite_food', 'pizza', self.db),
+                            {'joe'})
+        self.assertListEqual(Person.top_k('age', 1, self.db), ['joe'])
+        self.assertSetEqual(bob.smembers('friends'), {'joe'})
+        self.assertEqual(tom.hget('owner'), 'joe')
+        self.assertEqual(kit.hget('age'), 3)
+        self.assertListEqual(joe.zrange('tasks', 0, -1), ['write', 'read'])
+        self.assertListEqual(joe.lrange('events'), ['born', 'hired'])
+
+        Person.delete_many(['joe', 'bob'], self.db)
+        Cat.delete_many(['tom', 'kit'], self.db)
+
+    def test_check(self):
+        ids = ['p'+str(i) for i in range(12)]
+        people = Person.create_many(ids, self.db, fields=dict(
+            (id, {'ssn': 's'+id, 'age': i}) for i, id in enumerate(ids)))
+        tom, kit = Cat.create_many(['tom', 'kit'], self.db)
+        people[0].sadd('cats', tom, kit)
+        people[1].sadd('friends', people[2])
+        people[3].hset('favorite_food', 'pizza')
+        report = Person.check(self.db, workers=3, batch_size=5)
+        self.assertEqual(report['checked'], 12)
+        self.assertEqual(report['problems'], 0)
+
+        # simulate writes lost in a crash
+        self.db.hdel('ssn:sp4', 'person')
+        self.db.srem('person:p2:friends', 'p1')
+        self.db.hset('cat:kit', 'owner', 'p5')
+        self.db.hset('ssn:gone', 'person', 'p6')
+        self.db.srem('favorite_food:pizza:person', 'p3')
+        self.db.zadd('persons:age', {'p7': 99})
+        report = Person.check(self.db, workers=2, batch_size=4, max_rate=1e6)
+        self.assertEqual(report['problems'], 6)
+        self.assertEqual(report['repaired'], 0)
+        self.assertIn(('p4', 'ssn', 'sp4', 'missing lookup'),
+                      report['samples'])
+        self.assertIn(('p0', 'cats', 'kit', 'inverse bound to p5'),
+                      report['samples'])
+        self.assertIn(('p6', 'ssn', 'gone', 'stale lookup'),
+                      report['samples'])
+
+        report = Person.check(self.db, repair=True)
+        self.assertEqual(report['repaired'], 6)
+        self.assertEqual(Person.check(self.db)['problems'], 0)
+        self.assertEqual(Person.lookup('ssn', 'sp4', self.db), 'p4')
+        self.assertEqual(Person.lookup('ssn', 'gone', self.db), None)
+        self.assertSetEqual(people[2].smembers('friends'), {'p1'})
+        self.assertSetEqual(people[0].smembers('cats'), {'tom'})
+        self.assertSetEqual(Person.lookup('favorite_food', 'pizza', self.db),
+                            {'p3'})
+        self.assertListEqual(Person.top_k('age', 1, self.db), ['p11'])
+        # the cat side is consistent from its own point of view
+        self.db.hdel('cat:kit', 'owner')
+        self.assertEqual(Cat.check(self.db)['problems'], 0)
+
+        Person.delete_many(ids, self.db)
+        Cat.delete_many(['tom', 'kit'], self.db)
+
+    def test_lists(self):
+        joe = Person.create('joe', self.db)
+        self.assertEqual(joe.rpush('events', 'a', 'b'), 2)
+        self.assertEqual(joe.lpush('events', 'y', 'z'), 4)
+        self.assertListEqual(joe.lrange('events'), ['z', 'y', 'a', 'b'])
+        self.assertListEqual(joe.lrange('events', 1, 2), ['y', 'a'])
+        self.assertEqual(joe.rpush('events', 'c', 'd', maxlen=3), 3)
+        self.assertListEqual(joe.lrange('events'), ['b', 'c', 'd'])
+        self.assertEqual(joe.lpush('events', 'x', maxlen=2), 2)
+        self.assertListEqual(joe.lrange('events'), ['x', 'b'])
+        self.assertEqual(joe.llen('events'), 2)
+
+        joe.rpush('readings', *range(25))
+        self.assertListEqual(list(joe.iter_lrange('readings', count=10)),
+                             [float(i) for i in range(25)])
+        self.assertListEqual(joe.load(['readings'])['readings'][:2],
+                             [0.0, 1.0])
+        self.assertRaises(KeyError, joe.rpush, 'emails', 'a')
+        self.assertRaises(KeyError, joe.lrange, 'age')
+        self.assertRaises(ValueError, joe.rpush, 'events')
+        self.assertRaises(ValueError, joe.rpush, 'events', 'a', maxlen=0)
+        self.assertRaises(TypeError, Person.add_lookup, 'events')
+        self.assertNotIn('events', Person.lookups)
+        self.assertRaises(TypeError, apollo.relate, Person, 'log', [Cat],
+                          'logged_by')
+        self.assertNotIn('log', Person.fields)
+        self.assertNotIn('logged_by', Cat.fields)
+
+        joe.delete()
+        self.assertEqual(self.db.keys('person:joe*'), [])
+
+    def test_expiry(self):
+        joe = Person.create('joe', self.db, ttl=60)
+        jobs = Person.create_many(['j'+str(i) for i in range(5)], self.db,
+                                  fields={'j0': {'ssn': '000'}}, ttl=-1)
+        sphinx = Cat.create('sphinx', self.db)
+        joe.sadd('cats', sphinx)
+        jobs[1].sadd('friends', joe)
+        self.assertAlmostEqual(joe.ttl(), 60, delta=5)
+        self.assertEqual(jobs[0].ttl(), 0)
+        self.assertEqual(sphinx.ttl(), None)
+
+        # overdue entities are reaped in batches with their cleanup
+        self.assertEqual(len(Person.reap(self.db, batch_size=3)), 3)
+        reaper = apollo.Reaper(self.db, [Person, Cat], batch_size=1,
+                               max_batches=1)
+        self.assertEqual(reaper.tick(), 1)
+        self.assertEqual(reaper.tick(), 1)
+        self.assertEqual(reaper.tick(), 0)
+        self.assertSetEqual(Person.members(self.db), {'joe'})
+        self.assertEqual(Person.lookup('ssn', '000', self.db), None)
+        self.assertSetEqual(joe.smembers('friends'), set())
+
+        sphinx.expire(0.01)
+        self.assertTrue(joe.persist())
+        self.assertFalse(joe.persist())
+        self.assertListEqual(Person.reap(self.db, now=time.time()+3600), [])
+        reaper = apollo.Reaper(self.db, [Cat], interval=0.01)
+        reaper.start()
+        self.assertRaises(RuntimeError, reaper.start)
+        for _ in range(100):
+            if not Cat.exists('sphinx', self.db):
+                break
+            time.sleep(0.01)
+        reaper.stop()
+        self.assertSetEqual(joe.smembers('cats'), set())
+        self.assertSetEqual(Cat.members(self.db), set())
+
+        # deleting an expiring entity cancels its expiry
+        joe.expire(60)
+        joe.delete()
+        self.assertListEqual(self.db.keys('*'), [])
+
+    def test_related(self):
+        joe = Person.create('joe', self.db)
+        names = ['c'+str(i) for i in range(7)]
+        cats = Cat.create_many(names, self.db, fields=dict(
+            (name, {'age': i}) for i, name in enumerate(names)))
+        joe.sadd('cats', *cats)
+        joe.hset('single_cat', cats[3])
+
+        calls = []
+        execute_command = self.db.execute_command
+        self.db.execute_command = lambda *args, **kwargs: (
+            calls.append(args[0]) or execute_command(*args, **kwargs))
+        try:
+            collection = joe.related('cats', prefetch=['age'], page_size=3)
+            self.assertListEqual(calls, [])
+            self.assertEqual(len(collection), 7)
+            pages = [[cat.id for cat in page] for page in collection.pages()]
+            self.assertListEqual([len(page) for page in pages], [3, 3, 1])
+            self.assertListEqual(sorted(sum(pages, [])), names)
+            self.assertListEqual(sorted(cat.prefetched['age']
+                                        for cat in collection), list(range(7)))
+        finally:
+            del self.db.execute_command
+        # the set is streamed, and there is no SISMEMBER or HGET per cat
+        self.assertIn('SSCAN', calls)
+        self.assertNotIn('SORT', calls)
+        self.assertNotIn('SMEMBERS', calls)
+        self.assertNotIn('SISMEMBER', calls)
+        self.assertNotIn('HGET', calls)
+
+        self.assertListEqual([cat.id for cat in collection[2:4]],
+                             ['c2', 'c3'])
+        self.assertListEqual([cat.id for cat in collection[5:]], ['c5', 'c6'])
+        self.assertListEqual([cat.id for cat in collection[-3:-1]],
+                             ['c4', 'c5'])
+        self.assertListEqual([cat.id for cat in collection[1:6:2]],
+                             ['c1', 'c3', 'c5'])
+        self.assertListEqual(collection[4:2], [])
+        self.assertListEqual(collection.ids(1, 2), ['c1', 'c2'])
+        self.assertEqual(collection[-1].prefetched, {'age': 6})
+        self.assertListEqual([cat.id for cat in collection.page(2)], ['c6'])
+        self.assertRaises(IndexError, collection.__getitem__, 7)
+        self.assertIsInstance(collection[0], Cat)
+        self.assertEqual(Cat('c0', self.db).prefetched, None)
+
+        single = joe.related('single_cat', prefetch=['age'])
+        self.assertListEqual([cat.prefetched['age'] for cat in single], [3])
+        self.assertEqual(len(cats[0].related('owner')), 1)
+        self.assertEqual(len(joe.related('best_friend')), 0)
+        # one way relations have no inverse but work the same
+        joe.sadd('favorite_cats', cats[1], cats[5])
+        self.assertListEqual(sorted(cat.prefetched['age'] for cat in
+                                    joe.related('favorite_cats', ['age'])),
+                             [1, 5])
+        joe.hset('favorite_cat', cats[2])
+        self.assertEqual(joe.related('favorite_cat')[0].id, 'c2')
+        self.assertRaises(TypeError, joe.related, 'age')
+        self.assertRaises(TypeError, joe.related, 'cats', ['bad_field'])
+
+        joe.delete()
+        Cat.delete_many(names, self.db)
+
+    def test_mget(self):
+        joe = Person.create('joe', self.db)
+        bob = Person.create('bob', self.db)
+        joe.hset('age', 25)
+        joe.hset('ssn', '123-45-6789')
+        bob.hset('age', 30)
+
+        rows = Person.mget(['bob', 'eve', 'joe'], ['age', 'ssn'], self.db)
+        self.assertListEqual(rows, [{'age': 30, 'ssn': None},
+                                    None,
+                                    {'age': 25, 'ssn': '123-45-6789'}])
+        rows = Person.mget(['eve'], ['age'], self.db, check_exists=False)
+        self.assertListEqual(rows, [{'age': None}])
+        self.assertRaises(TypeError, Person.mget, ['joe'], ['emails'],
+                          self.db)
+
+        joe.delete()
+        bob.delete()
+
+    def test_unverified_instance(self):
+        joe = Person.create('joe', self.db)
+        self.assertRaises(KeyError, Person.instance, 'bob', self.db)
+        bob = Person.instance('bob', self.db, verify=False)
+        self.assertEqual(bob.id, 'bob')
+        same_joe = Person.instance('joe', self.db, verify=False)
+        apollo.Entity.verify([same_joe])
+        try:
+            apollo.Entity.verify([same_joe, bob,
+                           Cat.instance('sphinx', self.db, verify=False)])
+            raise Exception('expected exception to be thrown here')
+        except KeyError as e:
+            self.assertListEqual(sorted(e.args[0]), ['bob', 'sphinx'])
+        self.assertRaises(KeyError, joe.sadd, 'cats', 'sphinx')
+        joe.delete()
+
+    def test_iterators(self):
+        persons = Person.create_many(['p'+str(i) for i in range(30)],
+                                     self.db)
+        for person in persons[:20]:
+            person.hset('favorite_food', 'pizza')
+        persons[0].sadd('emails', *['e'+str(i) for i in range(25)])
+
+        self.assertSetEqual(set(Person.iter_members(self.db, count=7)),
+                            Person.members(self.db))
+        self.assertSetEqual(set(persons[0].iter_smembers('emails', count=4)),
+                            persons[0].smembers('emails'))
+        self.assertSetEqual(set(Person.iter_lookup('favorite_food', 'pizza',
+                                                   self.db, count=3)),
+                            Person.lookup('favorite_food', 'pizza', self.db))
+        self.assertEqual(Person.lookup_count('favorite_food', 'pizza',
+                                             self.db), 20)
+        self.assertEqual(Person.lookup_count('emails', 'e3', self.db), 1)
+        self.assertEqual(Person.lookup_count('emails', 'e99', self.db), 0)
+        sample = Person.lookup_sample('favorite_food', 'pizza', self.db, 5)
+        self.assertEqual(len(sample), 5)
+        self.assertTrue(set(sample) <= {p.id for p in persons[:20]})
+        self.assertRaises(TypeError, list,
+                          Person.iter_lookup('ssn', '123', self.db))
+
+        Person.delete_many([p.id for p in persons], self.db)
+
+    def test_range_index(self):
+        persons = Person.create_many(
+            ['joe', 'bob', 'eve'], self.db,
+            fields={'joe': {'age': 25}, 'bob': {'age': 40}})
+        joe, bob, eve = persons
+        eve.hset('age', 33)
+        self.assertListEqual(Person.range_lookup('age', 30, 40, self.db),
+                             ['eve', 'bob'])
+        self.assertListEqual(Person.range_lookup('age', '(33', '+inf',
+                                                 self.db), ['bob'])
+        self.assertListEqual(Person.range_lookup('age', '-inf', '+inf',
+                                                 self.db, offset=1, count=1),
+                             ['eve'])
+        self.assertListEqual(Person.top_k('age', 2, self.db, withscores=True),
+                             [('bob', 40), ('eve', 33)])
+
+        joe.hincrby('age', 10)
+        self.assertEqual(joe.hget('age'), 35)
+        self.assertListEqual(Person.top_k('age', 3, self.db),
+                             ['bob', 'joe', 'eve'])
+        bob.hdel('age')
+        self.assertListEqual(Person.top_k('age', 3, self.db), ['joe', 'eve'])
+        self.assertRaises(TypeError, Person.range_lookup, 'ssn', 0, 1,
+                          self.db)
+        self.assertRaises(TypeError, Person.add_range_index, 'ssn')
+
+        Person.delete_many(['joe', 'bob'], self.db)
+        self.assertListEqual(Person.top_k('age', 3, self.db), ['eve'])
+        eve.delete()
+
+    def test_query(self):
+        joe, bob, eve, amy = Person.create_many(['joe', 'bob', 'eve', 'amy'],
+                                                self.db)
+        joe.hset('favorite_food', 'pizza')
+        bob.hset('favorite_food', 'pizza')
+        eve.hset('favorite_food', 'sushi')
+        joe.sadd('favorite_songs', 'prelude')
+        bob.sadd('favorite_songs', 'nocturne')
+        eve.sadd('favorite_songs', 'prelude')
+
+        self.assertSetEqual(Person.query(self.db, favorite_food='pizza',
+                                         favorite_songs='prelude'), {'joe'})
+        self.assertEqual(Person.query(self.db, count_only=True,
+                                      favorite_food='pizza',
+                                      favorite_songs='prelude'), 1)
+        self.assertSetEqual(Person.query(
+            self.db, any_of=[('favorite_songs', 'prelude'),
+                             ('favorite_songs', 'nocturne')],
+            none_of=[('favorite_food', 'sushi')]), {'joe', 'bob'})
+        self.assertSetEqual(Person.query(
+            self.db, none_of=[('favorite_food', 'pizza')]), {'eve', 'amy'})
+        self.assertEqual(Person.query(self.db, count_only=True,
+                                      any_of=[('favorite_food', 'pizza'),
+                                              ('favorite_food', 'sushi')]),
+                         3)
+        self.assertRaises(TypeError, Person.query, self.db, ssn='123')
+
+        page = Person.query(self.db, none_of=[('favorite_food', 'sushi')],
+                            offset=0, count=2)
+        self.assertListEqual(page, ['amy', 'bob'])
+        # the stored result is reused for the following pages
+        amy.delete()
+        page = Person.query(self.db, none_of=[('favorite_food', 'sushi')],
+                            offset=2)
+        self.assertListEqual(page, ['joe'])
+        self.assertEqual(len(self.db.keys('persons:query:*')), 1)
+        # a first page, or refresh, sees writes made since
+        page = Person.query(self.db, none_of=[('favorite_food', 'sushi')],
+                            count=2)
+        self.assertListEqual(page, ['bob', 'joe'])
+        eve.hset('favorite_food', 'pizza')
+        page = Person.query(self.db, none_of=[('favorite_food', 'sushi')],
+                            offset=1, refresh=True)
+        self.assertListEqual(page, ['eve', 'joe'])
+        self.db.delete(*self.db.keys('persons:query:*'))
+
+        Person.delete_many(['joe', 'bob', 'eve'], self.db)
+
     def test_basic_sorted_set(self):
         joe = Person.create('joe', self.db)
         joe.zadd('tasks', 'sleep', 5)
@@ -430,6 +1331,220 @@ class TestApollo(unittest.TestCase):
 
         joe.delete()
 
+    def test_sorted_set_api(self):
+        joe = Person.create('joe', self.db)
+        self.assertEqual(joe.zadd('tasks', {'a': 3, 'b': 1, 'c': 2}), 3)
+        self.assertEqual(joe.zadd('tasks', 'a', 5, 'd', 4, nx=True), 1)
+        self.assertEqual(joe.zcard('tasks'), 4)
+        self.assertEqual(joe.zincrby('tasks', 'b', 10), 11.0)
+        self.assertListEqual(joe.zrange('tasks', 0, 1, withscores=True),
+                             [('c', 2.0), ('a', 3.0)])
+        self.assertListEqual(joe.zrevrange('tasks', 0, 0, withscores=True),
+                             [('b', 11.0)])
+        self.assertListEqual(joe.zrangebyscore('tasks', 2, '(4'), ['c', 'a'])
+        self.assertListEqual(joe.zrangebyscore('tasks', '-inf', '+inf',
+                                               offset=1, count=2),
+                             ['a', 'd'])
+        self.assertListEqual(joe.zpopmin('tasks', 2), [('c', 2.0), ('a', 3.0)])
+        self.assertListEqual(joe.zrange('tasks', 0, -1), ['d', 'b'])
+        self.assertRaises(KeyError, joe.zadd, 'emails', {'a': 1})
+        self.assertRaises(KeyError, joe.zrange, 'events', 0, -1)
+        self.assertRaises(TypeError, joe.zadd, 'tasks', 'a')
+
+        # ties across page boundaries are neither skipped nor repeated
+        joe.zremrangebyrank('tasks', 0, -1)
+        scores = dict(('t'+str(i), i // 4) for i in range(30))
+        joe.zadd('tasks', scores)
+        pairs = list(joe.iter_zrangebyscore('tasks', count=3,
+                                            withscores=True))
+        self.assertListEqual(sorted(member for member, score in pairs),
+                             sorted(scores))
+        self.assertListEqual([score for member, score in pairs],
+                             sorted(float(score) for score in scores.values()))
+        self.assertListEqual(list(joe.iter_zrangebyscore('tasks', 2, '(3',
+                                                         count=2)),
+                             ['t10', 't11', 't8', 't9'])
+
+        joe.delete()
+
+class TestApolloScripted(TestApollo):
+    """ Runs every test with the mutations executed as Lua scripts """
+
+    def setUp(self):
+        Person.scripted = True
+        Cat.scripted = True
+
+    def tearDown(self):
+        Person.scripted = False
+        Cat.scripted = False
+        super(TestApolloScripted, self).tearDown()
+
+    def test_script_reload(self):
+        joe = Person.create('joe', self.db)
+        self.db.script_flush()
+        joe.hset('ssn', '123-45-6789')
+        self.assertEqual(Person.lookup('ssn', '123-45-6789', self.db), 'joe')
+        joe.delete()
+
+class TestApolloCached(TestApollo):
+    """ Runs every test with reads served through a shared ReadCache """
+
+    def setUp(self):
+        self.cache = apollo.ReadCache(maxsize=100)
+        Person.cache = self.cache
+        Cat.cache = self.cache
+
+    def tearDown(self):
+        Person.cache = None
+        Cat.cache = None
+        self.cache.stop_listening()
+        super(TestApolloCached, self).tearDown()
+
+    def test_cache_stats_and_eviction(self):
+        self.cache.maxsize = 2
+        joe = Person.create('joe', self.db)
+        joe.hset('age', 25)
+        joe.hset('ssn', '123-45-6789')
+        self.assertEqual(joe.hget('age'), 25)
+        self.assertEqual(joe.hget('age'), 25)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(joe.hget('ssn'), '123-45-6789')
+        self.assertEqual(Person.lookup('ssn', '123-45-6789', self.db), 'joe')
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+        # writes made behind apollo's back are not seen without listening
+        self.assertEqual(joe.hget('favorite_food'), None)
+        self.db.hset('person:joe', 'favorite_food', 'pizza')
+        self.assertEqual(joe.hget('favorite_food'), None)
+        # but writes by apollo drop stale entries
+        joe.hincrby('age')
+        self.assertEqual(joe.hget('age'), 26)
+        self.assertEqual(joe.hget('favorite_food'), 'pizza')
+        self.db.hdel('person:joe', 'favorite_food')
+        joe.delete()
+
+    def test_cache_listen(self):
+        joe = Person.create('joe', self.db)
+        try:
+            self.cache.listen(self.db)
+        except redis.ResponseError:
+            joe.delete()
+            self.skipTest('CLIENT TRACKING is not supported by the server')
+        joe.hset('age', 25)
+        self.assertEqual(joe.hget('age'), 25)
+        # simulate a write from another process
+        self.db.hset('person:joe', 'age', 30)
+        for attempt in range(100):
+            if joe.hget('age') == 30:
+                break
+            time.sleep(0.01)
+        self.assertEqual(joe.hget('age'), 30)
+        joe.delete()
+
+class TestApolloAsync(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.db = redis.asyncio.Redis(decode_responses=True)
+        redis_client.flushdb()
+
+    async def asyncTearDown(self):
+        await self.db.aclose()
+        if redis_client.keys('*') != []:
+            redis_client.flushdb()
+            self.assertTrue(0)
+
+    async def test_async_relations_and_lookups(self):
+        APerson = apollo.AsyncEntity.of(Person)
+        ACat = apollo.AsyncEntity.of(Cat)
+        self.assertIs(apollo.AsyncEntity.of(Person), APerson)
+
+        joe, bob = await asyncio.gather(APerson.create('joe', self.db),
+                                        APerson.create('bob', self.db))
+        sphinx = await ACat.create('sphinx', self.db)
+        with self.assertRaises(KeyError):
+            await APerson.create('joe', self.db)
+        with self.assertRaises(KeyError):
+            await APerson.instance('eve', self.db)
+
+        await joe.hset('ssn', '123-45-6789')
+        await joe.hset('age', 25)
+        self.assertEqual(await joe.hget('age'), 25)
+        self.assertEqual(await APerson.lookup('ssn', '123-45-6789', self.db),
+                         'joe')
+        await joe.sadd('cats', sphinx)
+        self.assertEqual(await sphinx.hget('owner'), 'joe')
+        await bob.sadd('cats', 'sphinx')
+        self.assertSetEqual(await joe.smembers('cats'), set())
+        self.assertSetEqual(await bob.smembers('cats'), {'sphinx'})
+        await joe.sadd('friends', bob)
+        self.assertSetEqual(await bob.smembers('friends'), {'joe'})
+        with self.assertRaises(ValueError):
+            await joe.srem('cats', sphinx)
+
+        # the same data is visible through the synchronous classes
+        self.assertEqual(Cat('sphinx', redis_client).hget('owner'), 'bob')
+
+        rows = await APerson.mget(['joe', 'eve'], ['age', 'ssn'], self.db)
+        self.assertListEqual(rows, [{'age': 25, 'ssn': '123-45-6789'}, None])
+
+        await asyncio.gather(joe.delete(), bob.delete())
+        self.assertEqual(await sphinx.hget('owner'), None)
+        self.assertEqual(await APerson.lookup('ssn', '123-45-6789', self.db),
+                         None)
+        await sphinx.delete()
+
+    async def test_async_sorted_set(self):
+        APerson = apollo.AsyncEntity.of(Person)
+        joe = await APerson.create('joe', self.db)
+        await joe.zadd('tasks', {'sleep': 5, 'eat': 1})
+        self.assertListEqual(await joe.zrange('tasks', 0, -1),
+                             ['eat', 'sleep'])
+        await joe.zrem('tasks', 'eat')
+        self.assertEqual(await joe.zscore('tasks', 'sleep'), 5)
+        await joe.zadd('tasks', 'run', 2, 'walk', 1)
+        self.assertEqual(await joe.zincrby('tasks', 'walk', 5), 6)
+        self.assertListEqual(await joe.zrangebyscore('tasks', 2, 5,
+                                                     withscores=True),
+                             [('run', 2.0), ('sleep', 5.0)])
+        self.assertListEqual(await joe.zpopmin('tasks'), [('run', 2.0)])
+        await joe.rpush('events', 'a', 'b', 'c', maxlen=2)
+        self.assertEqual(await joe.llen('events'), 2)
+        self.assertListEqual(await joe.lrange('events'), ['b', 'c'])
+        await joe.delete()
+
+    async def test_async_layout_checked_per_call(self):
+        class Kennel(apollo.Entity):
+            prefix = 'kennel'
+            fields = {'name': str}
+
+        class Dog(apollo.Entity):
+            prefix = 'dog'
+            hash_tags = True
+            fields = {}
+
+        AKennel = apollo.AsyncEntity.of(Kennel)
+        kennel = await AKennel.create('k1', self.db)
+        await kennel.hset('name', 'barks')
+        with self.assertRaises(TypeError):
+            await kennel.hset('nmae', 'barks')
+        with self.assertRaises(TypeError):
+            await kennel.sadd('name', 'x')
+
+        # relating Kennel to a hash tagged class after wrapping it leaves
+        # the scripts unable to build the keys of its dogs
+        apollo.relate(Kennel, 'dogs', {Dog}, 'kennel')
+        Dog.create('rex', redis_client)
+        with self.assertRaises(TypeError):
+            await kennel.sadd('dogs', 'rex')
+        with self.assertRaises(TypeError):
+            await kennel.hdel('name')
+        self.assertEqual(await kennel.hget('name'), 'barks')
+        self.assertEqual(await kennel.scard('dogs'), 0)
+        Kennel('k1', redis_client).sadd('dogs', 'rex')
+        self.assertSetEqual(await kennel.smembers('dogs'), {'rex'})
+        await kennel.delete()
+        Dog('rex', redis_client).delete()
+
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
     unittest.TextTestRunner(verbosity=3).run(suite)